@@ -15,10 +15,17 @@ import torchaudio
 from transformers import Wav2Vec2FeatureExtractor, WavLMModel
 from torch import nn
 import numpy as np
-from sklearn.metrics import roc_curve
-from scipy.optimize import brentq
-from scipy.interpolate import interp1d
 import os
+import time
+import json
+import hashlib
+import fcntl
+import contextlib
+import functools
+import copy
+import itertools
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
 # Set device
@@ -32,105 +39,854 @@ feature_extractor = Wav2Vec2FeatureExtractor.from_pretrained(model_name)
 model = WavLMModel.from_pretrained(model_name).to(device)
 model.eval()
 
-# Function to load and preprocess audio
-def load_audio(file_path, target_sr=16000):
+# Resampling kernels are built once per (orig_sr, target_sr, dtype) and shared by every loader
+@functools.lru_cache(maxsize=None)
+def get_resampler(orig_sr, target_sr=16000, dtype=torch.float32):
+    return torchaudio.transforms.Resample(orig_sr, target_sr, dtype=dtype)
+
+def resample(waveform, orig_sr, target_sr=16000):
+    if orig_sr == target_sr:
+        return waveform
+    return get_resampler(orig_sr, target_sr, waveform.dtype)(waveform)
+
+# Resample many 1-D clips at once: clips sharing a source rate are zero-padded into one
+# batch, resampled in a single call and trimmed back to their own output length
+def resample_batch(waveforms, orig_srs, target_sr=16000):
+    if isinstance(orig_srs, int):
+        orig_srs = [orig_srs] * len(waveforms)
+    resampled = list(waveforms)
+    groups = {}
+    for i, sr in enumerate(orig_srs):
+        if sr != target_sr:
+            groups.setdefault(sr, []).append(i)
+    for sr, indices in groups.items():
+        lengths = [waveforms[i].size(-1) for i in indices]
+        batch = torch.zeros(len(indices), max(lengths), dtype=waveforms[indices[0]].dtype)
+        for row, i in enumerate(indices):
+            batch[row, :lengths[row]] = waveforms[i]
+        batch = resample(batch, sr, target_sr)
+        for row, i in enumerate(indices):
+            resampled[i] = batch[row, :int(np.ceil(lengths[row] * target_sr / sr))]
+    return resampled
+
+# Function to load and preprocess audio (resample_audio=False keeps the source rate)
+def load_audio(file_path, target_sr=16000, resample_audio=True):
     waveform, sample_rate = torchaudio.load(file_path)
-    if sample_rate != target_sr:
-        waveform = torchaudio.transforms.Resample(sample_rate, target_sr)(waveform)
+    if resample_audio:
+        waveform = resample(waveform, sample_rate, target_sr)
     return waveform.squeeze(0)  # Remove channel dimension if mono
 
+# Decode several files and resample them together
+def load_audio_batch(file_paths, target_sr=16000):
+    decoded = [torchaudio.load(path) for path in file_paths]
+    return resample_batch([w.squeeze(0) for w, _ in decoded], [sr for _, sr in decoded], target_sr)
+
+# Group utterance indices into length buckets: utterances are sorted longest first and
+# packed so that the padded batch (batch size x longest utterance) stays under the budget
+# and no utterance is padded by more than max_padding_ratio of the bucket length
+def make_length_buckets(lengths, max_samples_per_batch=16000 * 160, max_batch_size=64, max_padding_ratio=1.0):
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    batches, current = [], []
+    for idx in order:
+        longest = lengths[current[0]] if current else lengths[idx]
+        if current and (len(current) + 1 > max_batch_size or (len(current) + 1) * longest > max_samples_per_batch
+                        or longest - lengths[idx] > max_padding_ratio * longest):
+            batches.append(current)
+            current = []
+        current.append(idx)
+    if current:
+        batches.append(current)
+    return batches
+
+# Tensor version of the feature extractor's zero-mean/unit-variance normalisation: statistics
+# are taken over each clip's valid samples and padding is set back to padding_value
+def normalize_waveforms(waveforms, lengths, do_normalize=True, padding_value=0.0):
+    mask = torch.arange(waveforms.size(1), device=waveforms.device)[None, :] < lengths.to(waveforms.device)[:, None]
+    if do_normalize:
+        count = lengths.to(waveforms.device).clamp(min=1).to(waveforms.dtype)[:, None]
+        mean = (waveforms * mask).sum(dim=1, keepdim=True) / count
+        var = (((waveforms - mean) * mask) ** 2).sum(dim=1, keepdim=True) / count
+        waveforms = (waveforms - mean) / torch.sqrt(var + 1e-7)
+    return waveforms.masked_fill(~mask, padding_value), mask.long()
+
+# Tensor-in/tensor-out replacement for calling Wav2Vec2FeatureExtractor: takes a list of 1-D
+# waveforms (padded here, on the target device) or a padded [batch, samples] tensor with lengths,
+# and returns (input_values, attention_mask, lengths). The attention mask is None unless the
+# extractor config asks for one, as for WavLM Base+. No Python lists or numpy, and it is
+# differentiable, so it can sit between SepFormer and WavLM in training. identity goes into every
+# embedding-store key; bump version whenever the preprocessing changes the embeddings.
+class WavLMInputNormalizer(nn.Module):
+    version = 1
+
+    def __init__(self, do_normalize=True, return_attention_mask=False, padding_value=0.0):
+        super().__init__()
+        self.do_normalize = do_normalize
+        self.return_attention_mask = return_attention_mask
+        self.padding_value = padding_value
+
+    @property
+    def identity(self):
+        return f"tensornorm-v{self.version}:{int(self.do_normalize)}{int(self.return_attention_mask)}"
+
+    @classmethod
+    def from_feature_extractor(cls, extractor):
+        return cls(extractor.do_normalize, extractor.return_attention_mask, extractor.padding_value)
+
+    def forward(self, waveforms, lengths=None, device=None):
+        if isinstance(waveforms, (list, tuple)):
+            device = device or waveforms[0].device
+            lengths = torch.tensor([w.size(-1) for w in waveforms])
+            padded = torch.full((len(waveforms), int(lengths.max())), self.padding_value, device=device)
+            for row, waveform in enumerate(waveforms):
+                padded[row, :waveform.size(-1)] = waveform.reshape(-1).to(device, non_blocking=True)
+            waveforms = padded
+        else:
+            waveforms = waveforms.to(device or waveforms.device)
+            if lengths is None:
+                lengths = torch.full((waveforms.size(0),), waveforms.size(1))
+        input_values, attention_mask = normalize_waveforms(waveforms.float(), lengths, self.do_normalize, self.padding_value)
+        return input_values, attention_mask if self.return_attention_mask else None, lengths.cpu()
+
+wavlm_inputs = WavLMInputNormalizer.from_feature_extractor(feature_extractor)
+
+# Mean of the last hidden state over the valid (non-padded) frames only
+def pooled_embeddings(model, input_values, attention_mask=None, lengths=None):
+    outputs = model(input_values, attention_mask=attention_mask)
+    return masked_mean(model, outputs.last_hidden_state, lengths)
+
+def masked_mean(model, hidden, lengths=None):
+    if lengths is None:
+        return hidden.mean(dim=1)
+    frame_lengths = model._get_feat_extract_output_lengths(lengths.to(hidden.device))
+    frame_mask = (torch.arange(hidden.size(1), device=hidden.device)[None, :] < frame_lengths[:, None]).to(hidden.dtype)
+    return (hidden * frame_mask.unsqueeze(-1)).sum(dim=1) / frame_mask.sum(dim=1, keepdim=True).clamp(min=1)
+
+# Device holding a model's weights (CPU for dynamically quantised models)
+def model_device(model):
+    return next(model.parameters(), torch.empty(0, device=device)).device
+
+# Number of 16 kHz samples of a path or waveform (header only for paths). Containers whose
+# header has no frame count (some m4a) are decoded; pass decoded={} to keep those waveforms
+# so the caller does not decode them a second time.
+def utterance_length(item, target_sr=16000, decoded=None):
+    if isinstance(item, str):
+        info = torchaudio.info(item)
+        if info.num_frames > 0:
+            return int(np.ceil(info.num_frames * target_sr / info.sample_rate))
+        waveform = load_audio(item, target_sr)
+        if decoded is not None:
+            decoded[item] = waveform
+        return waveform.size(0)
+    return len(item)
+
+def as_waveform(item):
+    if isinstance(item, str):
+        return load_audio(item)
+    if isinstance(item, np.ndarray):
+        return torch.from_numpy(item).float().flatten()
+    return item.float().flatten()
+
+# Padding is not free for WavLM: the first conv layer group-normalises over the whole padded
+# length, and without an attention mask the transformer also attends to padded frames, so a
+# padded utterance's embedding drifts from its unpadded one even though pooling is masked.
+# Buckets therefore cap each utterance's padding at embedding_max_padding_ratio, which
+# calibrate_padding_ratio sets from the measured drift (None = no cap).
+embedding_max_padding_ratio = None
+
+# Batched embedding engine: embeds many paths or 16 kHz waveforms in length buckets and
+# yields numpy embeddings in input order ([num_outputs, dim] per item for multi-output embedders)
+def extract_embeddings_batched(items, model, max_samples_per_batch=16000 * 160, max_batch_size=64, max_padding_ratio=None):
+    items = list(items)
+    decoded_early = {}
+    lengths = [utterance_length(item, decoded=decoded_early) for item in items]
+    if max_padding_ratio is None:
+        max_padding_ratio = 1.0 if embedding_max_padding_ratio is None else embedding_max_padding_ratio
+    pending, next_idx = {}, 0
+    for batch in make_length_buckets(lengths, max_samples_per_batch, max_batch_size, max_padding_ratio):
+        # Files already decoded while measuring their length are not decoded again
+        early = {items[i] for i in batch if isinstance(items[i], str) and items[i] in decoded_early}
+        paths = [items[i] for i in batch if isinstance(items[i], str) and items[i] not in early]
+        decoded = dict(zip(paths, load_audio_batch(paths)))
+        decoded.update({path: decoded_early.pop(path) for path in early})
+        waveforms = [decoded[items[i]] if isinstance(items[i], str) else as_waveform(items[i]) for i in batch]
+        # Only models trained with attention masks get one; the pooling is masked either way
+        input_values, attention_mask, batch_lengths = wavlm_inputs(waveforms, device=model_device(model))
+        with torch.no_grad():
+            # Embedders with their own batched forward (e.g. DualWavLMEmbedder) provide embed_batch
+            if hasattr(model, "embed_batch"):
+                embeddings = model.embed_batch(input_values, attention_mask, batch_lengths).float().cpu().numpy()
+            else:
+                embeddings = pooled_embeddings(model, input_values, attention_mask, batch_lengths).cpu().numpy()
+        for i, embedding in zip(batch, embeddings):
+            pending[i] = embedding
+        while next_idx in pending:
+            yield pending.pop(next_idx)
+            next_idx += 1
+
 # Function to extract embeddings
 def extract_embedding(audio_path):
-    waveform = load_audio(audio_path)
-    # Process audio with feature extractor
-    inputs = feature_extractor(waveform, sampling_rate=16000, return_tensors="pt", padding=True)
-    input_values = inputs["input_values"].to(device)
-
-    with torch.no_grad():
-        outputs = model(input_values)
-        # Use the mean of the last hidden state as the embedding
-        embedding = outputs.last_hidden_state.mean(dim=1).squeeze().cpu().numpy()
-    return embedding
-
-# Cosine similarity function
-cosine_similarity = nn.CosineSimilarity(dim=0, eps=1e-6)
+    return next(extract_embeddings_batched([audio_path], model))
+
+# Cosine between each utterance embedded alone and embedded with zero padding making up the
+# given fraction of the padded length (masked pooling, attention mask as configured). Returns
+# the worst case per fraction.
+def measure_padding_drift(waveforms, model, fractions=(0.05, 0.1, 0.2, 0.3, 0.5)):
+    drift = {fraction: [] for fraction in fractions}
+    for waveform in waveforms:
+        reference = next(extract_embeddings_batched([waveform], model))
+        length = torch.tensor([waveform.size(0)])
+        for fraction in fractions:
+            padded = torch.zeros(1, int(np.ceil(waveform.size(0) / (1 - fraction))))
+            padded[0, :waveform.size(0)] = waveform
+            input_values, attention_mask, lengths = wavlm_inputs(padded, length, device=model_device(model))
+            with torch.no_grad():
+                embedding = pooled_embeddings(model, input_values, attention_mask, lengths)[0].cpu().numpy()
+            drift[fraction].append(float(np.dot(reference, embedding) / (np.linalg.norm(reference) * np.linalg.norm(embedding))))
+    for fraction, cosines in drift.items():
+        print(f"Padding {fraction:.0%}: min cosine {min(cosines):.5f}, mean cosine {np.mean(cosines):.5f}")
+    return {fraction: min(cosines) for fraction, cosines in drift.items()}
+
+# Largest padding fraction (checked in increasing order) whose worst-case cosine to the unpadded
+# embedding stays at or above min_cosine; becomes the engine's bucket padding cap
+def calibrate_padding_ratio(waveforms, model, min_cosine=0.995):
+    global embedding_max_padding_ratio
+    ratio = 0.0
+    for fraction, cosine in sorted(measure_padding_drift(waveforms, model).items()):
+        if cosine < min_cosine:
+            break
+        ratio = fraction
+    embedding_max_padding_ratio = ratio
+    print(f"Bucket padding capped at {ratio:.0%} of the bucket length (min cosine {min_cosine})")
+    return ratio
+
+# Throughput comparison: one utterance per forward pass vs the length-bucketed engine
+def benchmark_embedding_throughput(paths, model, max_samples_per_batch=16000 * 160):
+    waveforms = [load_audio(p) for p in paths]  # decode once so only WavLM time is compared
+    audio_seconds = sum(w.size(0) for w in waveforms) / 16000
+
+    start = time.perf_counter()
+    for waveform in waveforms:
+        input_values, _, _ = wavlm_inputs([waveform], device=model_device(model))
+        with torch.no_grad():
+            model(input_values)
+    single_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    list(extract_embeddings_batched(waveforms, model, max_samples_per_batch))
+    batched_time = time.perf_counter() - start
+
+    print(f"One-at-a-time: {len(waveforms) / single_time:.2f} utt/s ({audio_seconds / single_time:.1f}x real time)")
+    print(f"Batched:       {len(waveforms) / batched_time:.2f} utt/s ({audio_seconds / batched_time:.1f}x real time)")
+    return {"single_utt_per_sec": len(waveforms) / single_time, "batched_utt_per_sec": len(waveforms) / batched_time}
+
+# Cached file index for a VoxCeleb tree (speaker/session/file). The tree is listed in parallel
+# and saved as JSON (speaker -> session -> [name, size, mtime_ns, duration]); scan() stats the
+# directories and re-lists only those whose mtime changed since the saved index, so every stage
+# queries the index instead of walking the drive again. Existence comes from the directory
+# listings alone: files are not opened or stat'ed unless with_duration=True asks for durations
+# up front; otherwise records() and durations() probe size, mtime and duration lazily for the
+# files they return and save them, so length bucketing reads them from the index on later runs.
+# A file rewritten in place does not change its directory's mtime; delete the index file to
+# force a full rescan.
+class VoxCelebIndex:
+    def __init__(self, root, index_path, extensions=(".wav", ".m4a"), num_workers=16, with_duration=False):
+        self.root = root
+        self.index_path = index_path
+        self.extensions = tuple(extensions)
+        self.num_workers = num_workers
+        self.with_duration = with_duration
+        self.tree = {"mtime": None, "speakers": {}}
+        self._paths = None
+        if os.path.exists(index_path):
+            with open(index_path, "r") as f:
+                saved = json.load(f)
+            if saved["root"] == root and saved["extensions"] == list(self.extensions):
+                self.tree = saved["tree"]
+        self.scan()
+
+    # Seconds of audio (header only where possible; containers without a frame count are decoded
+    # once, and the result is kept in the index), None if the file cannot be read
+    @staticmethod
+    def _duration(path):
+        try:
+            return utterance_length(path) / 16000
+        except Exception:
+            return None
+
+    # List one session directory, reusing entries whose size and mtime are unchanged
+    def _list_session(self, session_path, previous):
+        known = {entry[0]: entry for entry in previous["files"]}
+        files = []
+        with os.scandir(session_path) as entries:
+            for entry in entries:
+                if not (entry.name.endswith(self.extensions) and entry.is_file()):
+                    continue
+                old = known.get(entry.name)
+                if not self.with_duration:
+                    files.append(old or [entry.name, None, None, None])
+                    continue
+                stat = entry.stat()
+                if old is not None and old[3] is not None and old[1:3] == [stat.st_size, stat.st_mtime_ns]:
+                    files.append(old)
+                else:
+                    files.append([entry.name, stat.st_size, stat.st_mtime_ns, self._duration(entry.path)])
+        return sorted(files, key=lambda entry: entry[0])
+
+    def _scan_speaker(self, speaker_id, previous):
+        speaker_path = os.path.join(self.root, speaker_id)
+        mtime = os.stat(speaker_path).st_mtime_ns
+        sessions = previous["sessions"]
+        if mtime != previous["mtime"]:
+            with os.scandir(speaker_path) as entries:
+                sessions = {e.name: sessions.get(e.name, {"mtime": None, "files": []}) for e in entries if e.is_dir()}
+        updated, relisted = {}, 0
+        for session, entry in sessions.items():
+            session_path = os.path.join(speaker_path, session)
+            session_mtime = os.stat(session_path).st_mtime_ns
+            if session_mtime != entry["mtime"]:
+                entry = {"mtime": session_mtime, "files": self._list_session(session_path, entry)}
+                relisted += 1
+            updated[session] = entry
+        return {"mtime": mtime, "sessions": updated}, relisted
+
+    def scan(self):
+        start = time.perf_counter()
+        speakers = self.tree["speakers"]
+        root_mtime = os.stat(self.root).st_mtime_ns
+        if root_mtime != self.tree["mtime"]:
+            with os.scandir(self.root) as entries:
+                speakers = {e.name: speakers.get(e.name, {"mtime": None, "sessions": {}}) for e in entries if e.is_dir()}
+        names = sorted(speakers)
+        with ThreadPoolExecutor(self.num_workers) as pool:
+            results = list(pool.map(self._scan_speaker, names, [speakers[name] for name in names]))
+        relisted = sum(r[1] for r in results)
+        changed = relisted > 0 or root_mtime != self.tree["mtime"]
+        self.tree = {"mtime": root_mtime, "speakers": {name: r[0] for name, r in zip(names, results)}}
+        self._paths = None
+        if changed:
+            self._save()
+        print(f"Indexed {len(names)} speakers under {self.root}: re-listed {relisted} sessions "
+              f"in {time.perf_counter() - start:.1f}s")
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.index_path) or ".", exist_ok=True)
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"root": self.root, "extensions": list(self.extensions), "tree": self.tree}, f)
+        os.replace(tmp_path, self.index_path)
+
+    def speakers(self):
+        return sorted(self.tree["speakers"])
+
+    # (path, index entry) for every indexed file of a speaker, in session then file-name order
+    def _entries(self, speaker_id, extensions=None):
+        extensions = self.extensions if extensions is None else tuple(extensions)
+        speaker_path = os.path.join(self.root, speaker_id)
+        return [(os.path.join(speaker_path, session, entry[0]), entry)
+                for session, info in sorted(self.tree["speakers"][speaker_id]["sessions"].items())
+                for entry in info["files"] if entry[0].endswith(extensions)]
+
+    # Fill in an entry's size, mtime and duration if missing or stale; True if it probed the file
+    def _probe(self, path, entry):
+        stat = os.stat(path)
+        if entry[3] is not None and entry[1:3] == [stat.st_size, stat.st_mtime_ns]:
+            return False
+        entry[1:4] = [stat.st_size, stat.st_mtime_ns, self._duration(path)]
+        return True
+
+    # (path, duration) for every indexed file of a speaker. Durations missing from the index, or
+    # recorded for an older size/mtime, are probed now and saved with the index.
+    def records(self, speaker_id, extensions=None):
+        entries = self._entries(speaker_id, extensions)
+        probed = [self._probe(path, entry) for path, entry in entries]
+        if any(probed):
+            self._save()
+        return [(path, entry[3]) for path, entry in entries]
+
+    # Durations in seconds for the given paths, probed and saved like records() but only for
+    # these files; None for paths outside the index or files that cannot be read
+    def durations(self, paths):
+        speakers = {os.path.relpath(path, self.root).split(os.sep)[0] for path in paths} & set(self.tree["speakers"])
+        entries = dict(entry for speaker_id in speakers for entry in self._entries(speaker_id))
+        probed = [self._probe(path, entries[path]) for path in set(paths) if path in entries]
+        if any(probed):
+            self._save()
+        return [entries[path][3] if path in entries else None for path in paths]
+
+    def files(self, speaker_id, extensions=None):
+        return [path for path, _ in self._entries(speaker_id, extensions)]
+
+    def files_by_speaker(self, speaker_ids, extensions=None):
+        return {speaker_id: self.files(speaker_id, extensions) for speaker_id in speaker_ids}
+
+    def labelled_files(self, speaker_ids, extensions=None):
+        return [(path, speaker_id) for speaker_id in speaker_ids for path in self.files(speaker_id, extensions)]
+
+    def first_file(self, speaker_id, extensions=None):
+        return self.files(speaker_id, extensions)[0]
+
+    def __contains__(self, path):
+        if self._paths is None:
+            self._paths = {path for speaker_id in self.tree["speakers"] for path in self.files(speaker_id)}
+        return path in self._paths
+
+# One index per dataset root per runtime; call .scan() to pick up changes on the drive
+file_index_dir = "/content/drive/MyDrive/Colab Notebooks/SEM03-Assignments/Speech Understanding/Assignment2/file_index"
+
+@functools.lru_cache(maxsize=None)
+def open_file_index(root, index_dir=file_index_dir):
+    name = hashlib.sha1(os.path.abspath(root).encode()).hexdigest()[:12]
+    return VoxCelebIndex(root, os.path.join(index_dir, f"{os.path.basename(root.rstrip('/'))}-{name}.json"))
+
+# Digests of a module's full state_dict as (base, adapters): LoRA tensors are hashed separately
+# and PEFT wrapping is stripped from the other names, so a LoRA model's base digest equals the
+# plain checkpoint's. Results are cached per module and reused while every tensor keeps its
+# storage and version counter; optimizer steps and load_state_dict update in place and bump
+# _version, so only changed weights force a re-hash.
+_state_digests = weakref.WeakKeyDictionary()
+
+def state_dict_digests(module):
+    state = module.state_dict(keep_vars=True)
+    stamp = tuple((name, value.data_ptr(), value._version) for name, value in state.items() if torch.is_tensor(value))
+    cached = _state_digests.get(module)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    base, adapters = hashlib.sha1(), hashlib.sha1()
+    named = sorted(((name.replace("base_model.model.", "", 1).replace(".base_layer.", "."), value)
+                    for name, value in state.items()), key=lambda item: item[0])
+    for name, value in named:
+        digest = adapters if "lora_" in name else base
+        digest.update(name.encode())
+        if torch.is_tensor(value):
+            digest.update(value.detach().float().cpu().contiguous().numpy().tobytes())
+        else:
+            digest.update(repr(value).encode())
+    has_adapters = any("lora_" in name for name, _ in named)
+    digests = (base.hexdigest()[:16], adapters.hexdigest()[:16] if has_adapters else None)
+    _state_digests[module] = (stamp, digests)
+    return digests
+
+# Identity of a model for embedding-store keys: checkpoint name, a digest of every weight and
+# buffer (plus the LoRA adapters when present) and the input preprocessing identity, so no two
+# weight versions or preprocessing versions ever share an entry
+def model_identity(model):
+    if getattr(model, "embedding_identity", None):
+        return model.embedding_identity
+    config = getattr(model, "config", None)
+    name = getattr(config, "_name_or_path", None) or type(model).__name__
+    base, adapters = state_dict_digests(model)
+    weights = base if adapters is None else f"{base}+lora-{adapters}"
+    return f"{name}:{weights}:{wavlm_inputs.identity}"
+
+# Exclusive inter-process writer lock: fcntl.flock on a lock file kept next to the data it guards
+@contextlib.contextmanager
+def file_lock(lock_path):
+    with open(lock_path, "a") as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
+# Persistent embedding store: float32 rows appended to a memory-mapped data file, plus an
+# append-only index.jsonl mapping (path, size, mtime, model identity) to a row.
+# Writers serialise on a lock file and write rows before their index lines, so readers
+# never take the writer lock and never see a row that is not fully on disk. compact()
+# rewrites both files under a new generation and swaps the index in atomically. Each store
+# holds a shared lock on {data file}.readers while it maps that generation, and superseded
+# data files are deleted (under the writer lock) only once nobody holds that lock any more.
+class EmbeddingStore:
+    def __init__(self, root, dim=768):
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.dim = dim
+        self.index_path = os.path.join(root, "index.jsonl")
+        self.lock_path = os.path.join(root, "store.lock")
+        self.index = {}
+        self.data_path = None
+        self._matrix = None
+        self._index_inode = None
+        self._index_offset = 0
+        self._pin_handle = None
+        with file_lock(self.lock_path):
+            if not os.path.exists(self.index_path):
+                self._write_index(self.index_path, f"embeddings-{int(time.time() * 1e6)}.f32", {})
+        self.refresh()
+
+    def _write_index(self, path, data_name, entries):
+        open(os.path.join(self.root, data_name), "ab").close()
+        open(os.path.join(self.root, data_name) + ".readers", "a").close()
+        with open(path, "w") as f:
+            f.write(json.dumps({"data": data_name, "dim": self.dim}) + "\n")
+            for key, row in entries.items():
+                f.write(json.dumps({"key": key, "row": row}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    # Shared lock on a generation's readers file, held while its data file is mapped. False if
+    # the generation was collected before the lock was taken (its data file is gone).
+    def _pin(self, data_path):
+        handle = open(data_path + ".readers", "a")
+        fcntl.flock(handle, fcntl.LOCK_SH)
+        if not os.path.exists(data_path):
+            handle.close()
+            return False
+        if self._pin_handle is not None:
+            self._pin_handle.close()
+        self._pin_handle = handle
+        return True
+
+    # Pick up index lines appended by other processes (or a new generation after compaction)
+    def refresh(self):
+        while True:
+            with open(self.index_path, "r") as f:
+                inode = os.fstat(f.fileno()).st_ino
+                if inode != self._index_inode:
+                    header = f.readline()  # written and fsynced before the index is swapped in
+                    data_path = os.path.join(self.root, json.loads(header)["data"])
+                    if not self._pin(data_path):
+                        continue  # collected by a compaction that has already swapped in a newer index
+                    self.index, self._index_offset, self._index_inode = {}, len(header.encode()), inode
+                    self.data_path, self._matrix = data_path, None
+                f.seek(self._index_offset)
+                for line in f:
+                    if not line.endswith("\n"):
+                        break  # a writer is still appending this line
+                    self._index_offset += len(line.encode())
+                    record = json.loads(line)
+                    self.index[record["key"]] = record["row"]
+            break
+        num_rows = max(self.index.values()) + 1 if self.index else 0
+        if num_rows == 0:
+            self._matrix = None
+        elif self._matrix is None or self._matrix.shape[0] < num_rows:
+            self._matrix = np.memmap(self.data_path, dtype=np.float32, mode="r", shape=(num_rows, self.dim))
+
+    @staticmethod
+    def key(path, identity):
+        stat = os.stat(path)
+        return json.dumps([os.path.abspath(path), stat.st_size, stat.st_mtime_ns, identity])
+
+    def append(self, keys, embeddings):
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32).reshape(len(keys), self.dim)
+        row_bytes = self.dim * 4
+        with file_lock(self.lock_path):
+            self.refresh()
+            with open(self.data_path, "r+b") as f:
+                # Drop a partial row left by a writer that died mid-append
+                first_row = os.path.getsize(self.data_path) // row_bytes
+                f.truncate(first_row * row_bytes)
+                f.seek(first_row * row_bytes)
+                f.write(embeddings.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self.index_path, "a") as f:
+                for offset, key in enumerate(keys):
+                    f.write(json.dumps({"key": key, "row": first_row + offset}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        self.refresh()
+
+    # Drop superseded rows and entries whose file has changed or disappeared
+    def compact(self):
+        with file_lock(self.lock_path):
+            self.refresh()
+            live = {}
+            for key, row in self.index.items():
+                path, size, mtime_ns, _ = json.loads(key)
+                if os.path.exists(path) and (os.stat(path).st_size, os.stat(path).st_mtime_ns) == (size, mtime_ns):
+                    live[key] = row
+            data_name = f"embeddings-{int(time.time() * 1e6)}.f32"
+            rows = sorted(live.values())
+            with open(os.path.join(self.root, data_name), "wb") as f:
+                for start in range(0, len(rows), 4096):
+                    f.write(np.ascontiguousarray(self._matrix[rows[start:start + 4096]]).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            new_row = {row: i for i, row in enumerate(rows)}
+            tmp_index = self.index_path + ".tmp"
+            self._write_index(tmp_index, data_name, {key: new_row[row] for key, row in live.items()})
+            os.replace(tmp_index, self.index_path)
+            self.refresh()  # moves this store's own pin to the new generation
+            self._collect_generations()
+        print(f"Compacted embedding store to {len(live)} rows")
+
+    # Delete superseded generations that no reader still maps; pinned ones are left for a later
+    # compact(). Called with the writer lock held, so no new generation appears meanwhile.
+    def _collect_generations(self):
+        current = os.path.basename(self.data_path)
+        names = {name[:-len(".readers")] if name.endswith(".readers") else name for name in os.listdir(self.root)
+                 if name.startswith("embeddings-") and name.endswith((".f32", ".f32.readers"))}
+        for name in names - {current}:
+            path = os.path.join(self.root, name)
+            with open(path + ".readers", "a") as handle:
+                try:
+                    fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                if os.path.exists(path):
+                    os.remove(path)
+                os.remove(path + ".readers")
+
+    # Embeddings for audio files, computing (and persisting) only the misses
+    # Multi-output embedders expose identities() and get one array per output back
+    def embed_files(self, paths, model, chunk_size=1024, **batch_kwargs):
+        identities = model.identities() if hasattr(model, "identities") else [model_identity(model)]
+        keys = [[self.key(path, identity) for identity in identities] for path in paths]
+        self.refresh()
+        missing = {}
+        for i, path_keys in enumerate(keys):
+            if any(key not in self.index for key in path_keys):
+                missing.setdefault(path_keys[0], i)
+        missing = list(missing.values())
+        # Persist in chunks so an interrupted run keeps what it already computed
+        for start in tqdm(range(0, len(missing), chunk_size), desc="Embedding store misses", disable=not missing):
+            chunk = missing[start:start + chunk_size]
+            embeddings = np.stack(list(extract_embeddings_batched([paths[i] for i in chunk], model, **batch_kwargs)))
+            self.append([key for i in chunk for key in keys[i]], embeddings.reshape(-1, self.dim))
+        outputs = [np.zeros((0, self.dim), dtype=np.float32) if not keys else
+                   self._matrix[[self.index[path_keys[k]] for path_keys in keys]] for k in range(len(identities))]
+        return outputs[0] if not hasattr(model, "identities") else tuple(outputs)
+
+# Parse a trial list once: labels, pairs of row indices into the unique file list, and the files
+def load_trial_list(trial_file, root):
+    labels, pairs, file_rows = [], [], {}
+    with open(trial_file, "r") as f:
+        for line in f:
+            label, file1, file2 = line.split()
+            labels.append(int(label))
+            pairs.append((file_rows.setdefault(file1, len(file_rows)), file_rows.setdefault(file2, len(file_rows))))
+    files = [os.path.join(root, name) for name in file_rows]
+    return np.asarray(labels, dtype=np.int8), np.asarray(pairs, dtype=np.int64).reshape(-1, 2), files
+
+# Vectorised trial scoring: embed only the unique files, L2-normalise them into one matrix and
+# score every trial with a gathered row-wise dot product. Trials are split into contiguous
+# shards so several processes can score one list; a finished shard is saved to output_dir
+# and loaded instead of recomputed, and embeddings resume through the store. Shard files are
+# keyed by the model identity and a hash of the trial-list contents and the audio root, so an
+# edited trial list or a different root never reuses stale scores.
+def score_trials(trial_file, root, model, store=None, max_trials=None, num_shards=1, shard_id=0,
+                 output_dir=None, chunk_size=1_000_000, file_index=None):
+    shard_path = None
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+        identity = hashlib.sha1(model_identity(model).encode()).hexdigest()[:12]
+        content = hashlib.sha1(os.path.abspath(root).encode())
+        with open(trial_file, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                content.update(block)
+        trial_name = os.path.splitext(os.path.basename(trial_file))[0]
+        shard_path = os.path.join(output_dir, f"{trial_name}_{content.hexdigest()[:12]}_{identity}_{max_trials}_"
+                                              f"{shard_id}of{num_shards}.npz")
+        if os.path.exists(shard_path):
+            shard = np.load(shard_path)
+            return shard["labels"], shard["scores"]
+
+    labels, pairs, files = load_trial_list(trial_file, root)
+    if max_trials is not None:
+        labels, pairs = labels[:max_trials], pairs[:max_trials]
+    bounds = np.linspace(0, len(labels), num_shards + 1).astype(np.int64)
+    labels, pairs = labels[bounds[shard_id]:bounds[shard_id + 1]], pairs[bounds[shard_id]:bounds[shard_id + 1]]
+
+    # One existence check per unique file instead of two per trial (an index lookup when given)
+    used = np.unique(pairs)
+    exists = os.path.exists if file_index is None else file_index.__contains__
+    present = np.array([exists(files[i]) for i in used], dtype=bool)
+    if not present.all():
+        print(f"Skipping trials with {int((~present).sum())} missing files, e.g. {files[used[~present][0]]}")
+    row_of = np.full(len(files), -1, dtype=np.int64)
+    row_of[used[present]] = np.arange(int(present.sum()))
+    pairs = row_of[pairs]
+    valid = (pairs >= 0).all(axis=1)
+    labels, pairs = labels[valid], pairs[valid]
+
+    present_files = [files[i] for i in used[present]]
+    if store is not None:
+        embeddings = store.embed_files(present_files, model)
+    else:
+        embeddings = np.stack(list(extract_embeddings_batched(present_files, model))) if present_files else np.zeros((0, 768))
+    embeddings = torch.from_numpy(np.asarray(embeddings, dtype=np.float32)).to(device)
+    embeddings = embeddings / embeddings.norm(dim=1, keepdim=True).clamp(min=1e-6)
+
+    scores = np.empty(len(pairs), dtype=np.float32)
+    for start in range(0, len(pairs), chunk_size):
+        chunk = torch.from_numpy(pairs[start:start + chunk_size]).to(device)
+        scores[start:start + chunk_size] = (embeddings[chunk[:, 0]] * embeddings[chunk[:, 1]]).sum(dim=1).cpu().numpy()
+
+    if shard_path is not None:
+        np.savez(shard_path, labels=labels, scores=scores)
+    return labels, scores
+
+# Concatenate the per-shard results written by score_trials, in shard order (a missing shard
+# is computed here, with the same store and file index)
+def merge_trial_shards(trial_file, root, model, output_dir, num_shards, max_trials=None, store=None, file_index=None):
+    results = [score_trials(trial_file, root, model, store=store, max_trials=max_trials, num_shards=num_shards,
+                            shard_id=k, output_dir=output_dir, file_index=file_index) for k in range(num_shards)]
+    return np.concatenate([r[0] for r in results]), np.concatenate([r[1] for r in results])
 
 # Paths
 voxceleb_root = "/content/drive/MyDrive/Colab Notebooks/SEM03-Assignments/Speech Understanding/Assignment2/wav"
+embedding_store_dir = "/content/drive/MyDrive/Colab Notebooks/SEM03-Assignments/Speech Understanding/Assignment2/embedding_store"
+embedding_store = EmbeddingStore(embedding_store_dir)
+voxceleb1_index = open_file_index(voxceleb_root)
 trial_file = "/content/drive/MyDrive/Colab Notebooks/SEM03-Assignments/Speech Understanding/Assignment2/VoxCeleb1-cleaned.txt"
 
-# Load trial pairs
-trials = []
-with open(trial_file, "r") as f:
-    for line in f:
-        label, file1, file2 = line.strip().split()
-        trials.append((int(label), file1, file2))
-
-# Dictionary to cache embeddings
-embedding_cache = {}
-
-# Compute similarity scores
-scores = []
-labels = []
-for label, file1, file2 in tqdm(trials[:1000]):  
-    file1_path = os.path.join(voxceleb_root, file1)
-    file2_path = os.path.join(voxceleb_root, file2)
-
-    # Verify file existence
-    if not os.path.exists(file1_path) or not os.path.exists(file2_path):
-        print(f"Skipping missing file: {file1_path} or {file2_path}")
-        continue
-
-    # Get embeddings (cache to avoid recomputation)
-    if file1_path not in embedding_cache:
-        embedding_cache[file1_path] = extract_embedding(file1_path)
-    if file2_path not in embedding_cache:
-        embedding_cache[file2_path] = extract_embedding(file2_path)
-
-    emb1 = torch.from_numpy(embedding_cache[file1_path]).to(device)
-    emb2 = torch.from_numpy(embedding_cache[file2_path]).to(device)
-
-    score = cosine_similarity(emb1, emb2).item()
-    scores.append(score)
-    labels.append(label)
+# Cap bucket padding so batched embeddings stay within cosine 0.995 of unpadded ones
+calibrate_padding_ratio([load_audio(path) for path in load_trial_list(trial_file, voxceleb_root)[2][:32]
+                         if path in voxceleb1_index], model)
+
+# Score the trial list (None = the full list) over its unique files
+num_trials = None
+labels, scores = score_trials(trial_file, voxceleb_root, model, embedding_store, max_trials=num_trials,
+                              file_index=voxceleb1_index)
+
+# Single-pass verification metrics engine. Scores are sorted once; every operating point
+# is then a prefix count over the sorted labels, taken only at distinct score values.
+# Rows of the count arrays are bootstrap replicates (a single row for the point estimate).
+# Rates come from integer counts so exact FAR targets are not missed by float rounding.
+def _metrics_from_counts(cum_pos, cum_neg, thresholds, far_targets, p_targets, c_miss, c_fa):
+    n_pos, n_neg = cum_pos[:, -1:], cum_neg[:, -1:]
+    n_fp = n_neg - cum_neg  # negatives accepted at each threshold
+    fnr = cum_pos / np.maximum(n_pos, 1)  # positives rejected at each threshold
+    fpr = n_fp / np.maximum(n_neg, 1)
+    rows = np.arange(fnr.shape[0])
+
+    # EER: linear interpolation where the decreasing FPR curve crosses the increasing FNR curve
+    j = np.clip(np.argmax(fnr >= fpr, axis=1), 1, fnr.shape[1] - 1)
+    d0 = fpr[rows, j - 1] - fnr[rows, j - 1]
+    d1 = fpr[rows, j] - fnr[rows, j]
+    t = d0 / np.where(d0 == d1, 1.0, d0 - d1)
+    eer = fnr[rows, j - 1] + t * (fnr[rows, j] - fnr[rows, j - 1])
+    eer_threshold = thresholds[j - 1] + t * (thresholds[j] - thresholds[j - 1])
+
+    # TAR at each FAR target: the lowest threshold accepting at most floor(far * negatives)
+    # negatives (the last threshold rejects everything, so one always exists)
+    tar = np.empty((fnr.shape[0], len(far_targets)))
+    for col, far in enumerate(far_targets):
+        allowed = np.floor(far * n_neg + 1e-9).astype(np.int64)
+        k = np.argmax(n_fp <= allowed, axis=1)
+        tar[:, col] = 1.0 - fnr[rows, k]
+
+    # Normalised minimum detection cost at each target prior
+    min_dcf = np.empty((fnr.shape[0], len(p_targets)))
+    for col, p in enumerate(p_targets):
+        dcf = c_miss * p * fnr + c_fa * (1 - p) * fpr
+        min_dcf[:, col] = dcf.min(axis=1) / min(c_miss * p, c_fa * (1 - p))
+    return {"eer": eer, "eer_threshold": eer_threshold, "tar": tar, "min_dcf": min_dcf}
+
+def verification_metrics(labels, scores, far_targets=(0.01,), p_targets=(0.01, 0.05), c_miss=1.0, c_fa=1.0,
+                         threshold=None, n_bootstrap=0, confidence=0.95, bootstrap_max_elements=2 ** 24, seed=0):
+    scores = np.asarray(scores, dtype=np.float32).ravel()
+    order = np.argsort(scores, kind="stable")
+    sorted_scores = scores[order]
+    positive = np.asarray(labels).ravel()[order] == 1
+    del order
+
+    # Threshold k accepts every score >= sorted_scores[starts[k]]; the last one rejects everything
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(sorted_scores)) + 1, [len(sorted_scores)]])
+    thresholds = np.append(sorted_scores[starts[:-1]], np.nextafter(sorted_scores[-1], np.float32(np.inf))).astype(np.float64)
+    cum_pos = np.concatenate([[0], np.cumsum(positive, dtype=np.int64)])[starts][None, :]
+    cum_neg = starts[None, :] - cum_pos
+    point = _metrics_from_counts(cum_pos, cum_neg, thresholds, far_targets, p_targets, c_miss, c_fa)
+
+    # Thresholded accuracy (at the EER threshold unless one is given): rejected negatives + accepted positives
+    if threshold is None:
+        threshold = float(point["eer_threshold"][0])
+    k = np.searchsorted(thresholds, threshold, side="left")
+    accuracy = (cum_neg[0, k] + cum_pos[0, -1] - cum_pos[0, k]) / len(sorted_scores)
+
+    result = {
+        "eer": float(point["eer"][0]) * 100,
+        "eer_threshold": float(point["eer_threshold"][0]),
+        "tar_at_far": {far: float(point["tar"][0, i]) * 100 for i, far in enumerate(far_targets)},
+        "min_dcf": {p: float(point["min_dcf"][0, i]) for i, p in enumerate(p_targets)},
+        "accuracy": float(accuracy) * 100,
+        "threshold": threshold,
+    }
+
+    # Poisson bootstrap on the per-score histogram: a sum of c Poisson(1) weights is Poisson(c),
+    # so each replicate draws its positive and negative count per distinct score directly.
+    # Replicates are generated in blocks of at most bootstrap_max_elements counts, independent
+    # of the number of trials (a single block row is one count per distinct score).
+    if n_bootstrap:
+        rng = np.random.default_rng(seed)
+        pos_bins, neg_bins = np.diff(cum_pos[0]), np.diff(cum_neg[0])
+        block = max(1, bootstrap_max_elements // len(pos_bins))
+        replicates = []
+        for start in range(0, n_bootstrap, block):
+            size = (min(block, n_bootstrap - start), len(pos_bins))
+            zeros = np.zeros((size[0], 1), dtype=np.int64)
+            rep_pos = np.concatenate([zeros, np.cumsum(rng.poisson(pos_bins, size=size), axis=1)], axis=1)
+            rep_neg = np.concatenate([zeros, np.cumsum(rng.poisson(neg_bins, size=size), axis=1)], axis=1)
+            replicates.append(_metrics_from_counts(rep_pos, rep_neg, thresholds, far_targets, p_targets, c_miss, c_fa))
+        alpha = (1 - confidence) / 2 * 100
+
+        def interval(values, scale=1.0):
+            low, high = np.percentile(values, [alpha, 100 - alpha])
+            return float(low) * scale, float(high) * scale
+
+        eers = np.concatenate([r["eer"] for r in replicates])
+        tars = np.concatenate([r["tar"] for r in replicates])
+        dcfs = np.concatenate([r["min_dcf"] for r in replicates])
+        result["ci"] = {
+            "eer": interval(eers, 100),
+            "tar_at_far": {far: interval(tars[:, i], 100) for i, far in enumerate(far_targets)},
+            "min_dcf": {p: interval(dcfs[:, i]) for i, p in enumerate(p_targets)},
+        }
+    return result
+
+# Regression check: TAR@FAR against a brute-force sweep over every threshold, on tied
+# synthetic scores with FAR targets that land exactly on a count of negatives
+def check_tar_at_far_against_sweep(far_targets=(0.01, 0.05, 0.1), seed=0):
+    rng = np.random.default_rng(seed)
+    trial_labels = np.concatenate([np.ones(300, dtype=np.int8), np.zeros(1000, dtype=np.int8)])
+    trial_scores = np.round(np.concatenate([rng.normal(0.6, 0.2, 300), rng.normal(0.3, 0.2, 1000)]), 2)
+    result = verification_metrics(trial_labels, trial_scores, far_targets=far_targets)
+    for far in far_targets:
+        best = 0.0
+        for threshold in np.append(np.unique(trial_scores), np.inf):
+            accepted = trial_scores >= threshold
+            if (accepted & (trial_labels == 0)).sum() <= np.floor(far * 1000 + 1e-9):
+                best = max(best, (accepted & (trial_labels == 1)).sum() / 300 * 100)
+        assert abs(result["tar_at_far"][far] - best) < 1e-9, (far, result["tar_at_far"][far], best)
+    print("TAR@FAR matches the brute-force threshold sweep")
+
+check_tar_at_far_against_sweep()
+metrics = verification_metrics(labels, scores, far_targets=(0.01,), n_bootstrap=200)
 
 # Metric 1: EER (in %)
 def compute_eer(labels, scores):
-    fpr, tpr, thresholds = roc_curve(labels, scores, pos_label=1)
-    fnr = 1 - tpr
-    eer_threshold = brentq(lambda x: 1. - x - interp1d(fpr, tpr)(x), 0., 1.)
-    eer = interp1d(fpr, fnr)(eer_threshold)
-    return eer * 100
+    return verification_metrics(labels, scores)["eer"]
 
-eer = compute_eer(labels, scores)
-print(f"Equal Error Rate (EER): {eer:.2f}%")
+eer = metrics["eer"]
+print(f"Equal Error Rate (EER): {eer:.2f}% (95% CI {metrics['ci']['eer'][0]:.2f}-{metrics['ci']['eer'][1]:.2f}%)")
 
 # Metric 2: TAR@1%FAR
 def compute_tar_at_far(labels, scores, target_far=0.01):
-    fpr, tpr, thresholds = roc_curve(labels, scores, pos_label=1)
-    tar_at_far = interp1d(fpr, tpr)(target_far)
-    return tar_at_far * 100
+    return verification_metrics(labels, scores, far_targets=(target_far,))["tar_at_far"][target_far]
 
-tar_at_1far = compute_tar_at_far(labels, scores, target_far=0.01)
+tar_at_1far = metrics["tar_at_far"][0.01]
 print(f"TAR@1%FAR: {tar_at_1far:.2f}%")
+print(f"minDCF (p=0.01): {metrics['min_dcf'][0.01]:.4f}, minDCF (p=0.05): {metrics['min_dcf'][0.05]:.4f}")
 
 # Metric 3: Speaker Identification Accuracy
 def compute_identification_accuracy(labels, scores, threshold=0.5):
-    predictions = [1 if score >= threshold else 0 for score in scores]
-    correct = sum(1 for pred, label in zip(predictions, labels) if pred == label)
-    accuracy = correct / len(labels) * 100  # Convert to percentage
-    return accuracy
+    predictions = np.asarray(scores) >= threshold
+    return np.mean(predictions == (np.asarray(labels) == 1)) * 100  # Convert to percentage
 
 # Use EER threshold for identification (optional: tune this)
-fpr, tpr, thresholds = roc_curve(labels, scores, pos_label=1)
-eer_threshold = thresholds[np.argmin(np.abs(fpr - (1 - tpr)))]
-id_accuracy = compute_identification_accuracy(labels, scores, threshold=eer_threshold)
+eer_threshold = metrics["eer_threshold"]
+id_accuracy = metrics["accuracy"]
 print(f"Speaker Identification Accuracy: {id_accuracy:.2f}%")
 
 # Save scores and labels for further analysis
 np.save("/content/drive/MyDrive/Colab Notebooks/SEM03-Assignments/Speech Understanding/Assignment2/scores.npy", np.array(scores))
 np.save("/content/drive/MyDrive/Colab Notebooks/SEM03-Assignments/Speech Understanding/Assignment2/labels.npy", np.array(labels))
 
+# Throughput of the batched engine against one-at-a-time extraction
+benchmark_files = [path for path in load_trial_list(trial_file, voxceleb_root)[2][:256] if os.path.exists(path)]
+benchmark_embedding_throughput(benchmark_files[:64], model)
+
 """**fine-tune Model**
 
 Lets fine-tune the microsoft/wavlm-base-plus model for speaker verification using LoRA (Low-Rank Adaptation) and ArcFace loss on the VoxCeleb2 dataset.
@@ -139,6 +895,9 @@ Lets fine-tune the microsoft/wavlm-base-plus model for speaker verification usin
 from peft import LoraConfig, get_peft_model
 import torch.nn.functional as F
 from torch.utils.data import Dataset, DataLoader
+from concurrent.futures import ThreadPoolExecutor
+import random
+import resource
 
 # ArcFace Loss Implementation
 class ArcFaceLoss(nn.Module):
@@ -158,22 +917,229 @@ class ArcFaceLoss(nn.Module):
         output = (one_hot * (theta + self.m) + (1.0 - one_hot) * theta).cos() * self.s
         return F.cross_entropy(output, labels)
 
-# Custom Dataset with padding/truncation
+# Pre-decoded audio cache: (path, speaker) files are decoded and resampled once into large
+# int16/float16 shard files plus an index of shard, offset, length, speaker and path.
+# Reads are memory-mapped views, so later epochs never touch ffmpeg or the mounted drive.
+# Empty clips are indexed with shard -1 and length 0 and take no shard space.
+def build_audio_cache(files, cache_dir, shard_samples=16000 * 3600, dtype="int16", num_workers=8):
+    index_path = os.path.join(cache_dir, "index.json")
+    paths = [path for path, _ in files]
+    if os.path.exists(index_path):
+        with open(index_path, "r") as f:
+            if json.load(f)["paths"] == paths:
+                return AudioCache(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    index = {"dtype": dtype, "shards": [], "paths": paths, "speakers": [speaker for _, speaker in files],
+             "shard": [], "offset": [], "length": []}
+    shard_file, shard_fill = None, shard_samples
+    # ffmpeg decoding releases the GIL, so threads overlap the slow reads
+    with ThreadPoolExecutor(num_workers) as pool:
+        for waveform in tqdm(pool.map(load_audio, paths), total=len(paths), desc="Building audio cache"):
+            if dtype == "int16":
+                samples = (waveform.clamp(-1.0, 1.0) * 32767).round().to(torch.int16).numpy()
+            else:
+                samples = waveform.to(torch.float16).numpy()
+            if len(samples) == 0:
+                index["shard"].append(-1)
+                index["offset"].append(0)
+                index["length"].append(0)
+                continue
+            if shard_fill + len(samples) > shard_samples and shard_fill > 0:
+                if shard_file is not None:
+                    shard_file.close()
+                index["shards"].append(f"shard_{len(index['shards']):05d}.bin")
+                shard_file, shard_fill = open(os.path.join(cache_dir, index["shards"][-1]), "wb"), 0
+            shard_file.write(samples.tobytes())
+            index["shard"].append(len(index["shards"]) - 1)
+            index["offset"].append(shard_fill)
+            index["length"].append(len(samples))
+            shard_fill += len(samples)
+    if shard_file is not None:
+        shard_file.close()
+
+    # The index is written last, so an interrupted build is simply rebuilt
+    with open(index_path + ".tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(index_path + ".tmp", index_path)
+    return AudioCache(cache_dir)
+
+class AudioCache:
+    def __init__(self, cache_dir):
+        with open(os.path.join(cache_dir, "index.json"), "r") as f:
+            index = json.load(f)
+        self.dtype = np.dtype(index["dtype"])
+        # Copy-on-write maps give writable (torch-compatible) views without touching the files
+        self.shards = [np.memmap(os.path.join(cache_dir, name), dtype=self.dtype, mode="c") for name in index["shards"]]
+        self.paths = index["paths"]
+        self.speakers = index["speakers"]
+        self.shard = np.asarray(index["shard"], dtype=np.int64)
+        self.offset = np.asarray(index["offset"], dtype=np.int64)
+        self.length = np.asarray(index["length"], dtype=np.int64)
+        self.position = {path: i for i, path in enumerate(self.paths)}
+
+    def __len__(self):
+        return len(self.paths)
+
+    # Zero-copy view of the stored samples of entry i
+    def view(self, i, start=0, num_samples=None):
+        if self.shard[i] < 0:
+            return np.zeros(0, dtype=self.dtype)  # empty clip
+        stop = self.length[i] if num_samples is None else min(self.length[i], start + num_samples)
+        return self.shards[self.shard[i]][self.offset[i] + start:self.offset[i] + stop]
+
+    # Float32 waveform of entry i; only the requested window is converted
+    def load(self, i, start=0, num_samples=None):
+        samples = torch.from_numpy(self.view(i, start, num_samples))
+        if self.dtype == np.int16:
+            return samples.float() / 32767
+        return samples.float()
+
+    def load_path(self, path, start=0, num_samples=None):
+        return self.load(self.position[path], start, num_samples)
+
+# Collate (waveform, speaker_id) items straight into normalised WavLM inputs, so the training
+# loop never round-trips batches through Python lists and the feature extractor
+class WavLMCollate:
+    def __init__(self, label_map, normalizer):
+        self.label_map = label_map
+        self.normalizer = normalizer
+
+    def __call__(self, items):
+        lengths = torch.tensor([waveform.size(0) for waveform, _ in items])
+        waveforms = torch.zeros(len(items), int(lengths.max()))
+        for row, (waveform, _) in enumerate(items):
+            waveforms[row, :waveform.size(0)] = waveform
+        input_values, attention_mask, lengths = self.normalizer(waveforms, lengths)
+        labels = torch.tensor([self.label_map[speaker_id] for _, speaker_id in items], dtype=torch.long)
+        padding_fraction = 1.0 - float(lengths.sum()) / waveforms.numel()
+        return {"input_values": input_values, "attention_mask": attention_mask, "lengths": lengths, "labels": labels,
+                "padding_fraction": padding_fraction}
+
+# Length-aware batch sampler: clips are grouped into length buckets, each bucket crops to its
+# own max length, and a bucket's batch size fills a budget of max_samples_per_batch padded
+# samples. Each item is (index, crop_length, seed) so the dataset takes a fresh random crop
+# every epoch.
+class BucketBatchSampler:
+    def __init__(self, lengths, bucket_boundaries=(32000, 48000, 64000, 96000, 128000), max_samples_per_batch=16 * 48000,
+                 shuffle=True, seed=0):
+        self.boundaries = sorted(bucket_boundaries)
+        self.max_samples_per_batch = max_samples_per_batch
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.buckets = [[] for _ in self.boundaries]
+        for idx, length in enumerate(lengths):
+            bucket = next((b for b, boundary in enumerate(self.boundaries) if length <= boundary), len(self.boundaries) - 1)
+            self.buckets[bucket].append((idx, int(length)))
+
+    def batch_size(self, bucket):
+        return max(1, self.max_samples_per_batch // self.boundaries[bucket])
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return sum(-(-len(items) // self.batch_size(b)) for b, items in enumerate(self.buckets))
+
+    def __iter__(self):
+        rng = random.Random(self.seed + self.epoch)
+        batches = []
+        for bucket, items in enumerate(self.buckets):
+            items = list(items)
+            if self.shuffle:
+                rng.shuffle(items)
+            crop = self.boundaries[bucket]
+            size = self.batch_size(bucket)
+            for start in range(0, len(items), size):
+                batches.append([(idx, min(length, crop), rng.randrange(2 ** 31)) for idx, length in items[start:start + size]])
+        if self.shuffle:
+            rng.shuffle(batches)
+        self.epoch += 1
+        return iter(batches)
+
+# Random crop offset for a clip of the given length (deterministic for a given seed)
+def crop_offset(length, crop_length, seed):
+    return random.Random(seed).randrange(length - crop_length + 1) if length > crop_length else 0
+
+# DataLoader with worker processes, bounded prefetch (prefetch_factor batches per worker)
+# and pinned memory when a GPU is present
+def make_loader(dataset, batch_size=None, shuffle=False, num_workers=None, prefetch_factor=4, collate_fn=None,
+                batch_sampler=None, sampler=None):
+    num_workers = min(8, os.cpu_count() or 1) if num_workers is None else num_workers
+    kwargs = {"num_workers": num_workers, "pin_memory": torch.cuda.is_available(), "collate_fn": collate_fn}
+    if num_workers > 0:
+        kwargs.update(prefetch_factor=prefetch_factor, persistent_workers=True)
+    if batch_sampler is not None:
+        return DataLoader(dataset, batch_sampler=batch_sampler, **kwargs)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle and sampler is None, sampler=sampler, **kwargs)
+
+# Splits loop wall-time into waiting for the next batch and running the step on it
+class StepTimer:
+    def __init__(self):
+        self.data_time = 0.0
+        self.compute_time = 0.0
+        self.steps = 0
+
+    def iterate(self, loader):
+        batches = iter(loader)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(batches)
+            except StopIteration:
+                return
+            ready = time.perf_counter()
+            self.data_time += ready - start
+            yield batch
+            self.compute_time += time.perf_counter() - ready
+            self.steps += 1
+
+    def report(self, prefix=""):
+        total = max(self.data_time + self.compute_time, 1e-9)
+        print(f"{prefix}data wait {self.data_time:.1f}s ({100 * self.data_time / total:.0f}%), "
+              f"compute {self.compute_time:.1f}s ({100 * self.compute_time / total:.0f}%) over {self.steps} steps, "
+              f"{1000 * total / max(self.steps, 1):.0f} ms/step")
+
+# Custom Dataset with padding/truncation (reads from an AudioCache when one is given)
 class VoxCeleb2Dataset(Dataset):
-    def __init__(self, files, max_length=48000):  # 3 seconds at 16kHz
+    def __init__(self, files, max_length=48000, cache=None, file_index=None):  # 3 seconds at 16kHz
         self.files = files
         self.max_length = max_length
+        self.cache = cache
+        self.file_index = file_index
 
     def __len__(self):
         return len(self.files)
 
+    # 16 kHz length of every clip, for the bucketing sampler: from the audio cache, else from the
+    # durations kept in the file index (probed once, then reused across runs)
+    def lengths(self):
+        if self.cache is not None:
+            return [int(self.cache.length[self.cache.position[path]]) for path, _ in self.files]
+        paths = [path for path, _ in self.files]
+        durations = self.file_index.durations(paths) if self.file_index is not None else [None] * len(paths)
+        return [utterance_length(path) if duration is None else int(round(duration * 16000))
+                for path, duration in zip(paths, durations)]
+
     def __getitem__(self, idx):
-        file_path, speaker_id = self.files[idx]
-        waveform, sample_rate = torchaudio.load(file_path)
-        if sample_rate != 16000:
-            waveform = torchaudio.transforms.Resample(sample_rate, 16000)(waveform)
-        waveform = waveform.squeeze(0)
+        # (index, crop_length, seed) from BucketBatchSampler: random crop, no padding
+        if isinstance(idx, tuple):
+            idx, crop_length, seed = idx
+            file_path, speaker_id = self.files[idx]
+            if self.cache is not None:
+                position = self.cache.position[file_path]
+                start = crop_offset(int(self.cache.length[position]), crop_length, seed)
+                return self.cache.load(position, start, crop_length), speaker_id
+            waveform = load_audio(file_path)
+            start = crop_offset(waveform.size(0), crop_length, seed)
+            return waveform[start:start + crop_length], speaker_id
 
+        file_path, speaker_id = self.files[idx]
+        if self.cache is not None:
+            waveform = self.cache.load_path(file_path, 0, self.max_length)
+        else:
+            waveform = load_audio(file_path)
 
         if waveform.size(0) > self.max_length:
             waveform = waveform[:self.max_length]
@@ -183,9 +1149,9 @@ class VoxCeleb2Dataset(Dataset):
 
         return waveform, speaker_id
 
-# Load pre-trained model and feature extractor
+# Load pre-trained model and input normalisation settings
 model_name = "microsoft/wavlm-base-plus"
-feature_extractor = Wav2Vec2FeatureExtractor.from_pretrained(model_name)
+wavlm_inputs = WavLMInputNormalizer.from_feature_extractor(Wav2Vec2FeatureExtractor.from_pretrained(model_name))
 model = WavLMModel.from_pretrained(model_name).to(device)
 
 # Apply LoRA
@@ -204,109 +1170,121 @@ voxceleb1_trial_file = "/content/drive/MyDrive/Colab Notebooks/SEM03-Assignments
 voxceleb1_root = "/content/drive/MyDrive/Colab Notebooks/SEM03-Assignments/Speech Understanding/Assignment2/wav"
 
 # Load VoxCeleb2 identities
-all_ids = sorted([d for d in os.listdir(voxceleb2_root) if os.path.isdir(os.path.join(voxceleb2_root, d))])[:118]
+voxceleb2_index = open_file_index(voxceleb2_root)
+all_ids = voxceleb2_index.speakers()[:118]
 train_ids = all_ids[:100]
 test_ids = all_ids[100:]
 
 # Prepare training data
-train_files = []
-for speaker_id in train_ids:
-    speaker_path = os.path.join(voxceleb2_root, speaker_id)
-    for session in os.listdir(speaker_path):
-        session_path = os.path.join(speaker_path, session)
-        files = [f for f in os.listdir(session_path) if f.endswith((".wav", ".m4a"))]
-        for file in files:
-            train_files.append((os.path.join(session_path, file), speaker_id))
+train_files = voxceleb2_index.labelled_files(train_ids)
 
 print(f"Collected {len(train_files)} training files from {len(train_ids)} speakers.")
 
-# Fine-tuning setup
-train_dataset = VoxCeleb2Dataset(train_files[:5000])  # Larger subset
-train_loader = DataLoader(train_dataset, batch_size=16, shuffle=True)
+# Fine-tuning setup: decode the subset once into a local audio cache
+audio_cache = build_audio_cache(train_files[:5000], "/content/audio_cache/vox2_train")
+train_dataset = VoxCeleb2Dataset(train_files[:5000], cache=audio_cache, file_index=voxceleb2_index)  # Larger subset
 optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
 arcface_loss = ArcFaceLoss(in_features=768, out_features=len(train_ids)).to(device)
 id_to_idx = {id: idx for idx, id in enumerate(train_ids)}
-
-# Training loop
-for epoch in range(5):
-    total_loss = 0
-    for waveforms, speaker_ids in tqdm(train_loader):
-
-        inputs = feature_extractor(waveforms.tolist(), sampling_rate=16000, return_tensors="pt", padding=True)
-        input_values = inputs["input_values"].to(device)
-
+train_sampler = BucketBatchSampler(train_dataset.lengths(), max_samples_per_batch=16 * 48000)
+train_loader = make_loader(train_dataset, batch_sampler=train_sampler,
+                           collate_fn=WavLMCollate(id_to_idx, wavlm_inputs))
+
+# Peak resident set size of this process in MB (ru_maxrss is in KB on Linux). It is a
+# lifetime peak, so compare configurations in fresh processes.
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+# Training loop. amp_dtype=torch.bfloat16 runs the WavLM forward under CPU autocast,
+# accumulation_steps micro-batches make one optimizer step, and freeze_feature_encoder stops
+# the CNN encoder from keeping its activations for backward (LoRA never trains it anyway).
+def finetune_wavlm(model, loader, arcface_loss, optimizer, epochs=5, accumulation_steps=1, amp_dtype=None,
+                   freeze_feature_encoder=False):
+    if freeze_feature_encoder:
+        (model.get_base_model() if hasattr(model, "get_base_model") else model).freeze_feature_encoder()
+    model.train()
+    for epoch in range(epochs):
+        total_loss = 0
+        padding_fractions = []
+        num_samples = 0
+        timer = StepTimer()
+        epoch_start = time.perf_counter()
         optimizer.zero_grad()
-        outputs = model(input_values).last_hidden_state.mean(dim=1)
-        labels = torch.tensor([id_to_idx[sid] for sid in speaker_ids], dtype=torch.long).to(device)
-        loss = arcface_loss(outputs, labels)
-        loss.backward()
-        optimizer.step()
-        total_loss += loss.item()
-    avg_loss = total_loss / len(train_loader)
-    print(f"Epoch {epoch+1}, Average Loss: {avg_loss:.4f}")
+        for step, batch in enumerate(tqdm(timer.iterate(loader), total=len(loader))):
+            padding_fractions.append(batch["padding_fraction"])
+            input_values = batch["input_values"].to(device, non_blocking=True)
+            attention_mask = batch["attention_mask"]
+            attention_mask = attention_mask.to(device, non_blocking=True) if attention_mask is not None else None
+            labels = batch["labels"].to(device, non_blocking=True)
+
+            with torch.autocast(device_type=device.type, dtype=amp_dtype or torch.float32, enabled=amp_dtype is not None):
+                outputs = pooled_embeddings(model, input_values, attention_mask, batch["lengths"])
+            # The margin (acos/cos) is kept in fp32
+            loss = arcface_loss(outputs.float(), labels)
+            # The last window may hold fewer micro-batches; average over the ones it actually has
+            window_size = min(accumulation_steps, len(loader) - step // accumulation_steps * accumulation_steps)
+            (loss / window_size).backward()
+            if (step + 1) % accumulation_steps == 0 or step + 1 == len(loader):
+                optimizer.step()
+                optimizer.zero_grad()
+            total_loss += loss.item()
+            num_samples += labels.size(0)
+        avg_loss = total_loss / len(loader)
+        samples_per_sec = num_samples / (time.perf_counter() - epoch_start)
+        print(f"Epoch {epoch+1}, Average Loss: {avg_loss:.4f}, Padding fraction: {np.mean(padding_fractions):.3f}, "
+              f"{samples_per_sec:.1f} samples/s, peak RSS {peak_rss_mb():.0f} MB")
+        timer.report(f"Epoch {epoch+1}: ")
+
+# bfloat16 autocast on GPU-less nodes; raise accumulation_steps for a larger effective batch
+finetune_wavlm(model, train_loader, arcface_loss, optimizer, epochs=5, accumulation_steps=1,
+               amp_dtype=torch.bfloat16 if device.type == "cpu" else None, freeze_feature_encoder=True)
 
 model.eval()
 
+# Pre-trained and fine-tuned embeddings from one LoRA model. LoRA only adapts the attention
+# projections, so the CNN feature encoder and feature projection are shared: they run once
+# and only the transformer encoder runs twice, with the adapters switched off and on.
+class DualWavLMEmbedder(nn.Module):
+    def __init__(self, peft_model):
+        super(DualWavLMEmbedder, self).__init__()
+        self.model = peft_model
+        self.wavlm = peft_model.get_base_model()
+
+    def identities(self):
+        name = self.wavlm.config._name_or_path or type(self.wavlm).__name__
+        # Adapters off leaves exactly the base weights, whose digest matches the plain checkpoint
+        return [f"{name}:{state_dict_digests(self.model)[0]}:{wavlm_inputs.identity}", model_identity(self.model)]
+
+    # [batch, 2, dim]: index 0 is the pre-trained embedding, index 1 the fine-tuned one
+    def embed_batch(self, input_values, attention_mask=None, lengths=None):
+        features = self.wavlm.feature_extractor(input_values).transpose(1, 2)
+        if attention_mask is not None:
+            attention_mask = self.wavlm._get_feature_vector_attention_mask(features.shape[1], attention_mask)
+        hidden_states, _ = self.wavlm.feature_projection(features)
+        # The encoder zeroes padded frames in place, so each pass gets its own copy
+        with self.model.disable_adapter():
+            pretrained = self.wavlm.encoder(hidden_states.clone(), attention_mask=attention_mask)[0]
+        finetuned = self.wavlm.encoder(hidden_states.clone(), attention_mask=attention_mask)[0]
+        return torch.stack([masked_mean(self.wavlm, pretrained, lengths), masked_mean(self.wavlm, finetuned, lengths)], dim=1)
+
 # Evaluation function
 def extract_embedding(audio_path, model):
-    waveform, sample_rate = torchaudio.load(audio_path)
-    if sample_rate != 16000:
-        waveform = torchaudio.transforms.Resample(sample_rate, 16000)(waveform)
-    waveform = waveform.squeeze(0)
-    inputs = feature_extractor(waveform.tolist(), sampling_rate=16e3, return_tensors="pt", padding=True)
-    input_values = inputs["input_values"].to(device)
-    with torch.no_grad():
-        outputs = model(input_values)
-        embedding = outputs.last_hidden_state.mean(dim=1).squeeze().cpu().numpy()
-    return embedding
-
-cosine_similarity = nn.CosineSimilarity(dim=0, eps=1e-6)
-
-# Load VoxCeleb1 trial pairs
-trials = []
-with open(voxceleb1_trial_file, "r") as f:
-    for line in f:
-        label, file1, file2 = line.strip().split()
-        trials.append((int(label), file1, file2))
+    return next(extract_embeddings_batched([audio_path], model))
 
 # Evaluate pre-trained and fine-tuned models
-def evaluate_model(model, name):
-    embedding_cache = {}
-    scores = []
-    labels = []
-    trial_subset = trials[:1000]
-    for label, file1, file2 in tqdm(trial_subset):
-        file1_path = os.path.join(voxceleb1_root, file1)
-        file2_path = os.path.join(voxceleb1_root, file2)
-
-        if not os.path.exists(file1_path) or not os.path.exists(file2_path):
-            print(f"Skipping missing file: {file1_path} or {file2_path}")
-            continue
-
-        if file1_path not in embedding_cache:
-            embedding_cache[file1_path] = extract_embedding(file1_path, model)
-        if file2_path not in embedding_cache:
-            embedding_cache[file2_path] = extract_embedding(file1_path, model)
-
-        emb1 = torch.from_numpy(embedding_cache[file1_path]).to(device)
-        emb2 = torch.from_numpy(embedding_cache[file2_path]).to(device)
-        score = cosine_similarity(emb1, emb2).item()
-        scores.append(score)
-        labels.append(label)
-
-    if not labels:
+def evaluate_model(model, name, max_trials=None):
+    labels, scores = score_trials(voxceleb1_trial_file, voxceleb1_root, model, embedding_store, max_trials=max_trials,
+                                  file_index=open_file_index(voxceleb1_root))
+
+    if len(labels) == 0:
         print(f"No valid trial pairs processed for {name}. Check voxceleb1_root and trial file paths.")
         return None, None, None
 
-    fpr, tpr, thresholds = roc_curve(labels, scores, pos_label=1)
-    fnr = 1 - tpr
-    eer = brentq(lambda x: 1. - x - interp1d(fpr, tpr)(x), 0., 1.) * 100
-    eer_threshold = thresholds[np.argmin(np.abs(fpr - (1 - tpr)))]
-    tar_at_1far = interp1d(fpr, tpr)(0.01) * 100
-    predictions = [1 if score >= eer_threshold else 0 for score in scores]
-    id_accuracy = sum(1 for pred, label in zip(predictions, labels) if pred == label) / len(labels) * 100
+    metrics = verification_metrics(labels, scores, far_targets=(0.01,))
+    eer, tar_at_1far, id_accuracy = metrics["eer"], metrics["tar_at_far"][0.01], metrics["accuracy"]
 
-    print(f"{name} - EER: {eer:.2f}%, TAR@1%FAR: {tar_at_1far:.2f}%, Speaker ID Accuracy: {id_accuracy:.2f}%")
+    print(f"{name} - EER: {eer:.2f}%, TAR@1%FAR: {tar_at_1far:.2f}%, Speaker ID Accuracy: {id_accuracy:.2f}%, "
+          f"minDCF(0.01): {metrics['min_dcf'][0.01]:.4f}")
     return eer, tar_at_1far, id_accuracy
 
 # Load pre-trained model for comparison
@@ -317,6 +1295,397 @@ pretrained_model.eval()
 pretrained_metrics = evaluate_model(pretrained_model, "Pre-trained")
 finetuned_metrics = evaluate_model(model, "Fine-tuned")
 
+"""**INT8 inference**"""
+
+# Dynamic INT8 inference: LoRA is merged into the base weights, then the Linear layers are
+# quantised to INT8 and the result is saved under the source model's identity, so later
+# starts load it instead of re-quantising. The attention projections stay fp32 because
+# WavLM's attention passes their weight tensors straight to F.multi_head_attention_forward.
+def quantize_wavlm(model, cache_dir="/content/drive/MyDrive/Colab Notebooks/SEM03-Assignments/Speech Understanding/Assignment2/quantized_models"):
+    identity = model_identity(model)
+    path = os.path.join(cache_dir, f"{hashlib.sha1(identity.encode()).hexdigest()[:16]}_int8.pt")
+    if os.path.exists(path):
+        quantized = torch.load(path, weights_only=False)
+    else:
+        merged = copy.deepcopy(model).cpu().eval()
+        if hasattr(merged, "merge_and_unload"):
+            merged = merged.merge_and_unload()
+        attention_projections = ("q_proj", "k_proj", "v_proj", "out_proj")
+        linear_names = {name for name, module in merged.named_modules()
+                        if isinstance(module, nn.Linear) and not name.endswith(attention_projections)}
+        quantized = torch.ao.quantization.quantize_dynamic(merged, linear_names, dtype=torch.qint8)
+        os.makedirs(cache_dir, exist_ok=True)
+        torch.save(quantized, path)
+    quantized.embedding_identity = f"{identity}+int8"
+    return quantized.eval()
+
+# Accuracy gate for INT8: re-score the trial list with both models and report the EER and
+# TAR@1%FAR shift; adopt the INT8 model only when the check passes. Speed is timed separately
+# on one batch of timing_utterances trial files, decoded once and embedded by both models
+# directly (never through the store), so a cache hit cannot make either model look faster.
+def quantization_regression_check(model, quantized, trial_file, root, store=None, max_trials=None,
+                                  max_eer_increase=0.5, max_tar_drop=1.0, timing_utterances=64):
+    metrics, seconds = {}, {}
+    for tag, candidate in (("fp32", model), ("int8", quantized)):
+        labels, scores = score_trials(trial_file, root, candidate, store, max_trials=max_trials)
+        metrics[tag] = verification_metrics(labels, scores, far_targets=(0.01,))
+
+    files = [path for path in load_trial_list(trial_file, root)[2] if os.path.exists(path)][:timing_utterances]
+    waveforms = [load_audio(path) for path in files]
+    for tag, candidate in (("fp32", model), ("int8", quantized)):
+        list(extract_embeddings_batched(waveforms[:2], candidate))  # warm-up
+        start = time.perf_counter()
+        list(extract_embeddings_batched(waveforms, candidate))
+        seconds[tag] = 1000 * (time.perf_counter() - start) / max(len(waveforms), 1)
+    eer_shift = metrics["int8"]["eer"] - metrics["fp32"]["eer"]
+    tar_shift = metrics["int8"]["tar_at_far"][0.01] - metrics["fp32"]["tar_at_far"][0.01]
+    passed = eer_shift <= max_eer_increase and -tar_shift <= max_tar_drop
+    print(f"FP32 - EER: {metrics['fp32']['eer']:.2f}%, TAR@1%FAR: {metrics['fp32']['tar_at_far'][0.01]:.2f}% "
+          f"({seconds['fp32']:.1f} ms/utt on {model_device(model)})")
+    print(f"INT8 - EER: {metrics['int8']['eer']:.2f}%, TAR@1%FAR: {metrics['int8']['tar_at_far'][0.01]:.2f}% "
+          f"({seconds['int8']:.1f} ms/utt on {model_device(quantized)})")
+    print(f"EER shift: {eer_shift:+.2f}%, TAR@1%FAR shift: {tar_shift:+.2f}% -> {'PASS' if passed else 'FAIL'}")
+    return passed, eer_shift, tar_shift
+
+quantized_model = quantize_wavlm(model)
+int8_passed, _, _ = quantization_regression_check(model, quantized_model, voxceleb1_trial_file, voxceleb1_root, store=embedding_store)
+
+# Gate: the INT8 model serves CPU embedding only when the check passed (it runs on the CPU only,
+# so GPU runtimes keep the fp32 model)
+serving_model = quantized_model if int8_passed and device.type == "cpu" else model
+print(f"Serving embeddings with the {'INT8' if serving_model is quantized_model else 'FP32'} model")
+
+"""**Compiled inference**"""
+
+# Embedding forward as one module, (input_values, attention_mask) -> masked-mean embedding.
+# The sample mask always drives the pooling; it is passed to WavLM only when the extractor
+# config asks for one, the same rule extract_embeddings_batched follows.
+class PooledWavLM(nn.Module):
+    def __init__(self, model, use_attention_mask=False):
+        super(PooledWavLM, self).__init__()
+        self.model = model
+        self.use_attention_mask = use_attention_mask
+
+    def forward(self, input_values, attention_mask):
+        mask = attention_mask if self.use_attention_mask else None
+        hidden = self.model(input_values, attention_mask=mask, return_dict=False)[0]
+        frame_lengths = self.model._get_feat_extract_output_lengths(attention_mask.sum(dim=1))
+        frame_mask = (torch.arange(hidden.size(1), device=hidden.device)[None, :] < frame_lengths[:, None]).to(hidden.dtype)
+        return (hidden * frame_mask.unsqueeze(-1)).sum(dim=1) / frame_mask.sum(dim=1, keepdim=True).clamp(min=1)
+
+# Point Inductor's on-disk cache at one directory while graphs compile. torch.compile is lazy,
+# so this wraps the calls that may compile; the previous setting is restored afterwards.
+@contextlib.contextmanager
+def inductor_cache_dir(path):
+    previous = os.environ.get("TORCHINDUCTOR_CACHE_DIR")
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = path
+    try:
+        yield
+    finally:
+        if previous is None:
+            os.environ.pop("TORCHINDUCTOR_CACHE_DIR", None)
+        else:
+            os.environ["TORCHINDUCTOR_CACHE_DIR"] = previous
+
+# Compiled single-utterance embedding path. Inputs are zero-padded up to a length bucket
+# (bucket_seconds steps) and run through a graph specialised to that shape: a TorchScript
+# trace saved as {cache key}_{bucket}.pt, or a torch.compile graph whose Inductor artifacts
+# are kept in inductor_{cache key}/. The cache key covers the model identity, the device and
+# the torch version, since a trace is only valid for all three. Warm starts load instead of
+# re-compiling; utterances longer than max_seconds fall back to eager mode.
+class CompiledEmbedder:
+    def __init__(self, model, cache_dir, backend="trace", bucket_seconds=1.0, max_seconds=20.0):
+        self.device = model_device(model)
+        key = f"{model_identity(model)}|{self.device}|torch-{torch.__version__}"
+        self.cache_key = hashlib.sha1(key.encode()).hexdigest()[:16]
+        self.model = copy.deepcopy(model).merge_and_unload() if hasattr(model, "merge_and_unload") else model
+        self.model.eval()
+        self.cache_dir = cache_dir
+        self.inductor_dir = os.path.join(cache_dir, f"inductor_{self.cache_key}")
+        self.backend = backend
+        self.bucket = int(bucket_seconds * 16000)
+        self.max_samples = int(max_seconds * 16000)
+        self.graphs = {}
+        os.makedirs(cache_dir, exist_ok=True)
+        if backend == "compile":
+            torch._inductor.config.fx_graph_cache = True
+
+    def _graph(self, bucket_length):
+        if bucket_length in self.graphs:
+            return self.graphs[bucket_length]
+        pooled = PooledWavLM(self.model, wavlm_inputs.return_attention_mask).eval()
+        if self.backend == "compile":
+            graph = torch.compile(pooled, dynamic=False)
+        else:
+            path = os.path.join(self.cache_dir, f"{self.cache_key}_{bucket_length}.pt")
+            if os.path.exists(path):
+                graph = torch.jit.load(path, map_location=self.device)
+            else:
+                # Half-length mask so the trace keeps the masking ops rather than folding them away
+                example = (torch.zeros(1, bucket_length, device=self.device),
+                           (torch.arange(bucket_length, device=self.device) < bucket_length // 2).long()[None])
+                with torch.no_grad():
+                    graph = torch.jit.freeze(torch.jit.trace(pooled, example, check_trace=False, strict=False))
+                torch.jit.save(graph, path)
+        self.graphs[bucket_length] = graph
+        return graph
+
+    def embed(self, waveform):
+        waveform = as_waveform(waveform).to(self.device)
+        length = torch.tensor([waveform.size(0)])
+        if waveform.size(0) > self.max_samples:
+            bucket_length, graph = waveform.size(0), PooledWavLM(self.model, wavlm_inputs.return_attention_mask)
+        else:
+            bucket_length = -(-waveform.size(0) // self.bucket) * self.bucket
+            graph = self._graph(bucket_length)
+        padded = torch.zeros(1, bucket_length, device=waveform.device)
+        padded[0, :waveform.size(0)] = waveform
+        input_values, _, _ = wavlm_inputs(padded, length)
+        attention_mask = (torch.arange(bucket_length, device=waveform.device) < waveform.size(0)).long()[None]
+        with torch.no_grad(), inductor_cache_dir(self.inductor_dir) if self.backend == "compile" else contextlib.nullcontext():
+            return graph(input_values, attention_mask)[0].cpu().numpy()
+
+# Per-utterance latency of eager vs compiled embedding, grouped by utterance length. The eager
+# reference is extract_embeddings_batched itself (same normaliser, same attention-mask rule), and
+# any length whose compiled embedding falls below min_cosine of it is flagged.
+def benchmark_compiled_latency(waveforms, model, compiled, repeats=10, min_cosine=0.99):
+    def eager_embed(waveform):
+        return next(extract_embeddings_batched([waveform], model))
+
+    latencies = {}
+    for waveform in waveforms:
+        seconds = int(np.ceil(waveform.size(0) / 16000))
+        eager_embed(waveform), compiled.embed(waveform)  # warm-up (loads or builds the bucket graph)
+        row = latencies.setdefault(seconds, {"eager": [], "compiled": [], "cosine": []})
+        for _ in range(repeats):
+            start = time.perf_counter()
+            reference = eager_embed(waveform)
+            row["eager"].append(1000 * (time.perf_counter() - start))
+            start = time.perf_counter()
+            embedding = compiled.embed(waveform)
+            row["compiled"].append(1000 * (time.perf_counter() - start))
+        row["cosine"].append(float(np.dot(reference, embedding) / (np.linalg.norm(reference) * np.linalg.norm(embedding))))
+
+    print(f"{'length':>7} {'eager p50':>10} {'eager p99':>10} {'comp p50':>10} {'comp p99':>10} {'min cos':>8}")
+    for seconds in sorted(latencies):
+        row = latencies[seconds]
+        eager_p50, eager_p99 = np.percentile(row["eager"], [50, 99])
+        comp_p50, comp_p99 = np.percentile(row["compiled"], [50, 99])
+        flag = "" if min(row["cosine"]) >= min_cosine else "  <- below tolerance"
+        print(f"{seconds:>6}s {eager_p50:>8.1f}ms {eager_p99:>8.1f}ms {comp_p50:>8.1f}ms {comp_p99:>8.1f}ms {min(row['cosine']):>8.4f}{flag}")
+    return latencies
+
+compiled_model = CompiledEmbedder(model, "/content/drive/MyDrive/Colab Notebooks/SEM03-Assignments/Speech Understanding/Assignment2/compiled_models")
+benchmark_compiled_latency([load_audio(path) for path in benchmark_files[:32]], model, compiled_model)
+
+"""**Early-exit embeddings**"""
+
+# Run only the first num_layers transformer layers by swapping in a truncated layer list
+@contextlib.contextmanager
+def truncated_encoder(model, num_layers):
+    wavlm = model.get_base_model() if hasattr(model, "get_base_model") else model
+    layers = wavlm.encoder.layers
+    wavlm.encoder.layers = layers[:num_layers]
+    try:
+        yield
+    finally:
+        wavlm.encoder.layers = layers
+
+# Early-exit speaker embedding: the first num_layers layers run, and the masked-mean pooled
+# hidden states (CNN projection output plus each layer) are combined with softmax layer
+# weights. With pool_layers=False it returns the per-layer embeddings for calibration.
+class LayerWeightedEmbedder(nn.Module):
+    def __init__(self, model, num_layers, layer_weights=None, pool_layers=True):
+        super(LayerWeightedEmbedder, self).__init__()
+        self.model = model
+        self.num_layers = num_layers
+        self.pool_layers = pool_layers
+        weights = torch.ones(num_layers + 1) if layer_weights is None else torch.as_tensor(layer_weights, dtype=torch.float32)
+        self.register_buffer("layer_logits", torch.log(weights / weights.sum()))
+
+    @property
+    def embedding_identity(self):
+        digest = hashlib.sha1(self.layer_logits.detach().cpu().numpy().tobytes()).hexdigest()[:8]
+        return f"{model_identity(self.model)}+exit{self.num_layers}:{digest}"
+
+    def embed_batch(self, input_values, attention_mask=None, lengths=None):
+        with truncated_encoder(self.model, self.num_layers):
+            hidden_states = self.model(input_values, attention_mask=attention_mask, output_hidden_states=True).hidden_states
+        layers = torch.stack([masked_mean(self.model, hidden, lengths) for hidden in hidden_states], dim=1)
+        if not self.pool_layers:
+            return layers
+        return (torch.softmax(self.layer_logits.to(layers.device), dim=0)[None, :, None] * layers).sum(dim=1)
+
+# Pick the exit layer and layer weights on the trial list: per-layer embeddings of every
+# trial file come from one full forward each. Speakers are split into a fitting half and a
+# held-out half, keeping only trials whose two files fall on the same side; for every candidate
+# depth the softmax weights (plus a score scale and bias) are fitted with a logistic loss on
+# the fitting trials, and EER is reported on the held-out trials alongside ms/utterance.
+# The shallowest depth within eer_tolerance of the best held-out EER wins.
+def calibrate_layer_exit(model, trial_file, root, timing_waveforms, candidate_layers=(2, 4, 6, 8, 10, 12),
+                         max_trials=5000, steps=200, eer_tolerance=0.25, held_out_fraction=0.5, seed=0):
+    labels, pairs, files = load_trial_list(trial_file, root)
+    labels, pairs = labels[:max_trials], pairs[:max_trials]
+    used = np.unique(pairs)
+    present = np.array([os.path.exists(files[i]) for i in used], dtype=bool)
+    row_of = np.full(len(files), -1, dtype=np.int64)
+    row_of[used[present]] = np.arange(int(present.sum()))
+    pairs = row_of[pairs]
+    valid = (pairs >= 0).all(axis=1)
+    labels, pairs = labels[valid], pairs[valid]
+
+    # Speaker-disjoint split (speaker = first directory under root); cross-split trials are dropped
+    speakers = np.array([os.path.relpath(files[i], root).split(os.sep)[0] for i in used[present]])
+    unique_speakers = np.unique(speakers)
+    held_out = np.random.default_rng(seed).permutation(len(unique_speakers))[:int(round(held_out_fraction * len(unique_speakers)))]
+    held_out_rows = np.isin(speakers, unique_speakers[held_out])
+    fit = ~held_out_rows[pairs].any(axis=1)
+    test = held_out_rows[pairs].all(axis=1)
+    print(f"Layer-exit calibration: {int(fit.sum())} fitting trials, {int(test.sum())} held-out trials "
+          f"({len(unique_speakers) - len(held_out)} / {len(held_out)} speakers)")
+    fit_labels, fit_pairs = labels[fit], torch.from_numpy(pairs[fit])
+    test_labels, test_pairs = labels[test], torch.from_numpy(pairs[test])
+
+    depth = max(candidate_layers)
+    layer_embeddings = torch.from_numpy(np.stack(list(extract_embeddings_batched(
+        [files[i] for i in used[present]], LayerWeightedEmbedder(model, depth, pool_layers=False)))))
+    targets = torch.from_numpy(fit_labels.astype(np.float32))
+
+    curve = []
+    for num_layers in candidate_layers:
+        logits = torch.zeros(num_layers + 1, requires_grad=True)
+        scale_bias = torch.tensor([10.0, -5.0], requires_grad=True)
+        optimizer = torch.optim.Adam([logits, scale_bias], lr=0.05)
+        for _ in range(steps):
+            embeddings = F.normalize((torch.softmax(logits, 0)[None, :, None] * layer_embeddings[:, :num_layers + 1]).sum(1), dim=1)
+            scores = (embeddings[fit_pairs[:, 0]] * embeddings[fit_pairs[:, 1]]).sum(1)
+            loss = F.binary_cross_entropy_with_logits(scale_bias[0] * scores + scale_bias[1], targets)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+        with torch.no_grad():
+            embeddings = F.normalize((torch.softmax(logits, 0)[None, :, None] * layer_embeddings[:, :num_layers + 1]).sum(1), dim=1)
+            scores = (embeddings[test_pairs[:, 0]] * embeddings[test_pairs[:, 1]]).sum(1).numpy()
+        eer = verification_metrics(test_labels, scores)["eer"]
+
+        embedder = LayerWeightedEmbedder(model, num_layers, torch.softmax(logits.detach(), 0))
+        list(extract_embeddings_batched(timing_waveforms[:1], embedder))  # warm-up
+        start = time.perf_counter()
+        for waveform in timing_waveforms:
+            next(extract_embeddings_batched([waveform], embedder))
+        ms_per_utt = 1000 * (time.perf_counter() - start) / len(timing_waveforms)
+        curve.append({"layers": num_layers, "eer": eer, "ms_per_utt": ms_per_utt, "embedder": embedder})
+        print(f"Layers: {num_layers:2d}, held-out EER: {eer:.2f}%, {ms_per_utt:.1f} ms/utt, "
+              f"weights: {np.round(torch.softmax(logits.detach(), 0).numpy(), 3)}")
+
+    best_eer = min(point["eer"] for point in curve)
+    chosen = min((point for point in curve if point["eer"] <= best_eer + eer_tolerance), key=lambda point: point["layers"])
+    print(f"Selected {chosen['layers']} layers (held-out EER {chosen['eer']:.2f}%, {chosen['ms_per_utt']:.1f} ms/utt)")
+    return chosen["embedder"], [{k: v for k, v in point.items() if k != "embedder"} for point in curve]
+
+exit_embedder, exit_curve = calibrate_layer_exit(model, voxceleb1_trial_file, voxceleb1_root,
+                                                 [load_audio(path) for path in benchmark_files[:16]])
+
+"""**Long recordings**"""
+
+# Overlapping windows of a recording as 16 kHz tensors. Paths are read one window at a time
+# (frame_offset/num_frames), so only the current windows are ever held in memory; containers
+# whose header has no frame count (some m4a) are streamed and resampled by the decoder instead.
+def iter_audio_windows(item, window, hop):
+    if isinstance(item, str):
+        info = torchaudio.info(item)
+        if info.num_frames == 0:
+            yield from stream_audio_windows(item, window, hop)
+            return
+        sr, total = info.sample_rate, info.num_frames
+        src_window, src_hop = int(np.ceil(window * sr / 16000)), int(np.ceil(hop * sr / 16000))
+        starts = list(range(0, max(total - src_window, 0) + 1, src_hop))
+        if starts[-1] + src_window < total:
+            starts.append(total - src_window)
+        for start in starts:
+            chunk, _ = torchaudio.load(item, frame_offset=start, num_frames=src_window)
+            yield resample(chunk, sr).squeeze(0)
+        return
+    waveform = as_waveform(item)
+    starts = list(range(0, max(waveform.size(0) - window, 0) + 1, hop))
+    if starts[-1] + window < waveform.size(0):
+        starts.append(waveform.size(0) - window)
+    for start in starts:
+        yield waveform[start:start + window]
+
+# Same windows as iter_audio_windows for a file of unknown length: StreamReader decodes hop-sized
+# 16 kHz chunks and at most one window plus one hop is buffered. The final window is aligned to
+# the end of the file once the stream runs out.
+def stream_audio_windows(path, window, hop):
+    reader = torchaudio.io.StreamReader(path)
+    reader.add_basic_audio_stream(frames_per_chunk=hop, sample_rate=16000)
+    buffer, previous = torch.zeros(0), None
+    for (chunk,) in reader.stream():
+        buffer = torch.cat([buffer, chunk.mean(dim=1)])
+        while buffer.size(0) >= window:
+            previous = buffer[:window]
+            yield previous
+            buffer = buffer[hop:]
+    if previous is None:
+        if buffer.size(0):
+            yield buffer  # shorter than one window
+    elif buffer.size(0) > window - hop:
+        yield torch.cat([previous[:hop], buffer])[-window:]
+
+# Sliding-window embedding for long recordings: windows are embedded window_batch at a time
+# and combined by a length-weighted mean, or by attention weights from each window's cosine
+# similarity to that mean. Peak memory is set by window_batch x window, not by duration.
+def extract_embedding_long(item, model, window_seconds=6.0, hop_seconds=4.0, window_batch=8, aggregate="mean",
+                           temperature=0.1):
+    window, hop = int(window_seconds * 16000), int(hop_seconds * 16000)
+    embeddings, weights, batch = [], [], []
+    for chunk in itertools.chain(iter_audio_windows(item, window, hop), [None]):
+        if chunk is not None:
+            batch.append(chunk)
+            weights.append(chunk.size(0))
+        if batch and (chunk is None or len(batch) == window_batch):
+            embeddings.extend(extract_embeddings_batched(batch, model, max_samples_per_batch=window_batch * window))
+            batch = []
+    embeddings, weights = np.stack(embeddings), np.asarray(weights, dtype=np.float64)
+    mean = (weights[:, None] * embeddings).sum(axis=0) / weights.sum()
+    if aggregate == "mean":
+        return mean.astype(np.float32)
+    similarity = embeddings @ mean / (np.linalg.norm(embeddings, axis=1) * np.linalg.norm(mean) + 1e-8)
+    attention = np.exp((similarity - similarity.max()) / temperature) * weights
+    return ((attention[:, None] * embeddings).sum(axis=0) / attention.sum()).astype(np.float32)
+
+# On inputs no longer than one window the long-audio mode must match extract_embedding. On
+# multi-window inputs (each item tiled to window_counts overlapping windows) it must stay within
+# multi_window_tolerance, in cosine, of one full-length extract_embedding pass.
+def check_long_audio_equivalence(items, model, window_seconds=6.0, hop_seconds=4.0, tolerance=1e-4,
+                                 multi_window_tolerance=0.05, window_counts=(3, 4, 5)):
+    def cosine(a, b):
+        return float(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)))
+
+    window, hop = int(window_seconds * 16000), int(hop_seconds * 16000)
+    worst_short, worst_long = 1.0, 1.0
+    for item in items:
+        if utterance_length(item) <= window:
+            reference = next(extract_embeddings_batched([item], model))
+            for aggregate in ("mean", "attention"):
+                embedding = extract_embedding_long(item, model, window_seconds, hop_seconds, aggregate=aggregate)
+                worst_short = min(worst_short, cosine(reference, embedding))
+        waveform = as_waveform(item)
+        for count in window_counts:
+            length = window + (count - 1) * hop
+            tiled = waveform.repeat(-(-length // waveform.size(0)))[:length]
+            reference = next(extract_embeddings_batched([tiled], model))
+            for aggregate in ("mean", "attention"):
+                embedding = extract_embedding_long(tiled, model, window_seconds, hop_seconds, aggregate=aggregate)
+                worst_long = min(worst_long, cosine(reference, embedding))
+    print(f"Long-audio mode vs extract_embedding: min cosine {worst_short:.6f} on short inputs, "
+          f"{worst_long:.6f} on {window_counts[0]}-{window_counts[-1]} window inputs")
+    assert worst_short >= 1 - tolerance, "long-audio embedding diverges from extract_embedding on short inputs"
+    assert worst_long >= 1 - multi_window_tolerance, "long-audio embedding diverges from a full-length pass"
+    return worst_short, worst_long
+
+check_long_audio_equivalence(benchmark_files[:16], serving_model)
+
 """# Q. III A , Step 1: Create the Multi-Speaker Dataset"""
 
 import os
@@ -325,6 +1694,9 @@ import torchaudio
 import numpy as np
 from tqdm import tqdm
 import random
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 # Paths
 voxceleb2_root = "/content/drive/MyDrive/Colab Notebooks/SEM03-Assignments/Speech Understanding/Assignment2/vox2/aac"
@@ -334,65 +1706,138 @@ os.makedirs(output_train_dir, exist_ok=True)
 os.makedirs(output_test_dir, exist_ok=True)
 
 # Load VoxCeleb2 identities (sorted ascending)
-all_ids = sorted([d for d in os.listdir(voxceleb2_root) if os.path.isdir(os.path.join(voxceleb2_root, d))])
+all_ids = open_file_index(voxceleb2_root).speakers()
 train_ids = all_ids[:50]  # First 50 for training
 test_ids = all_ids[50:100]  # Next 50 for testing
 
-# Function to load and resample audio
+# Function to load and resample audio (shares the cached resampling kernels)
 def load_audio(file_path, target_sr=16000):
     waveform, sample_rate = torchaudio.load(file_path)
-    if sample_rate != target_sr:
-        waveform = torchaudio.transforms.Resample(sample_rate, target_sr)(waveform)
-    return waveform.squeeze(0)
-# Function to mix two utterances
-def mix_utterances(file1, file2, max_length=48000):  # 3 seconds
-    wav1 = load_audio(file1)
-    wav2 = load_audio(file2)
-
-    # Truncate or pad to max_length
-    if wav1.size(0) > max_length:
-        wav1 = wav1[:max_length]
-    elif wav1.size(0) < max_length:
-        wav1 = torch.cat([wav1, torch.zeros(max_length - wav1.size(0))])
+    return resample(waveform, sample_rate, target_sr).squeeze(0)
+# Crop a waveform at offset and truncate or pad it to max_length
+def fit_length(waveform, max_length, offset=0):
+    waveform = waveform[offset:offset + max_length]
+    if waveform.size(0) < max_length:
+        waveform = torch.cat([waveform, torch.zeros(max_length - waveform.size(0))])
+    return waveform
+
+# Mix two sources with the given gains and peak-normalise the mixture
+def mix_sources(wav1, wav2, gain1, gain2):
+    mixture = gain1 * wav1 + gain2 * wav2
+    return mixture / torch.max(torch.abs(mixture)).clamp(min=1e-8)
 
-    if wav2.size(0) > max_length:
-        wav2 = wav2[:max_length]
-    elif wav2.size(0) < max_length:
-        wav2 = torch.cat([wav2, torch.zeros(max_length - wav2.size(0))])
+# Function to mix two utterances
+def mix_utterances(file1, file2, max_length=48000, gains=None, offsets=(0, 0)):  # 3 seconds
+    wav1 = fit_length(load_audio(file1), max_length, offsets[0])
+    wav2 = fit_length(load_audio(file2), max_length, offsets[1])
 
     # Mix with random gain between 0.5 and 1.0
-    gain1, gain2 = random.uniform(0.5, 1.0), random.uniform(0.5, 1.0)
-    mixture = gain1 * wav1 + gain2 * wav2
-    mixture = mixture / torch.max(torch.abs(mixture))
+    gain1, gain2 = gains if gains is not None else (random.uniform(0.5, 1.0), random.uniform(0.5, 1.0))
+    mixture = mix_sources(wav1, wav2, gain1, gain2)
 
     return mixture, wav1, wav2
 
-# Collect files for each identity
+# Collect files for each identity (from the cached file index)
 def collect_files(ids, root_dir):
-    files_dict = {}
-    for speaker_id in ids:
-        speaker_path = os.path.join(root_dir, speaker_id)
-        files = []
-        for session in os.listdir(speaker_path):
-            session_path = os.path.join(speaker_path, session)
-            files.extend([os.path.join(session_path, f) for f in os.listdir(session_path) if f.endswith(".m4a")])
-        files_dict[speaker_id] = files
-    return files_dict
-
-# Create mixtures
-def create_mixtures(ids, files_dict, output_dir, num_mixtures=100):
-    for i in tqdm(range(num_mixtures)):
-        # Randomly select two different speakers
-        spk1, spk2 = random.sample(ids, 2)
-        file1 = random.choice(files_dict[spk1])
-        file2 = random.choice(files_dict[spk2])
-
-        mixture, wav1, wav2 = mix_utterances(file1, file2)
-
-        # Save mixture and original sources
-        torchaudio.save(os.path.join(output_dir, f"mix_{i}.wav"), mixture.unsqueeze(0), 16000)
-        torchaudio.save(os.path.join(output_dir, f"src1_{i}.wav"), wav1.unsqueeze(0), 16000)
-        torchaudio.save(os.path.join(output_dir, f"src2_{i}.wav"), wav2.unsqueeze(0), 16000)
+    return open_file_index(root_dir).files_by_speaker(ids, extensions=(".m4a",))
+
+# Plan mixtures deterministically: mixture i draws its speakers, files and render seed from
+# its own generator seeded by (seed, i), so results do not depend on worker scheduling
+def plan_mixtures(ids, files_dict, output_dir, num_mixtures, seed=0, max_length=48000, random_offsets=True):
+    jobs = []
+    for i in range(num_mixtures):
+        rng = random.Random(f"{seed}-{i}")
+        spk1, spk2 = rng.sample(ids, 2)
+        jobs.append({"mixture_id": i, "speakers": [spk1, spk2],
+                     "sources": [rng.choice(sorted(files_dict[spk1])), rng.choice(sorted(files_dict[spk2]))],
+                     "seed": rng.randrange(2 ** 32), "output_dir": output_dir, "max_length": max_length,
+                     "random_offsets": random_offsets})
+    return jobs
+
+# Render one planned mixture from its two decoded 16 kHz sources: returns the (path, waveform)
+# pairs to write and the mixture's manifest record
+def render_mixture(job, sources):
+    rng = random.Random(job["seed"])
+    max_length = job["max_length"]
+    wav1, wav2 = sources
+    offsets = [rng.randint(0, max(w.size(0) - max_length, 0)) if job["random_offsets"] else 0 for w in (wav1, wav2)]
+    gains = [rng.uniform(0.5, 1.0), rng.uniform(0.5, 1.0)]
+    wav1, wav2 = fit_length(wav1, max_length, offsets[0]), fit_length(wav2, max_length, offsets[1])
+    mixture = mix_sources(wav1, wav2, *gains)
+    snr = 10 * np.log10(float((gains[0] * wav1).pow(2).sum()) / (float((gains[1] * wav2).pow(2).sum()) + 1e-8) + 1e-8)
+
+    i, output_dir = job["mixture_id"], job["output_dir"]
+    outputs = [(os.path.join(output_dir, f"mix_{i}.wav"), mixture), (os.path.join(output_dir, f"src1_{i}.wav"), wav1),
+               (os.path.join(output_dir, f"src2_{i}.wav"), wav2)]
+    return outputs, {"mixture_id": i, "speakers": job["speakers"], "sources": job["sources"], "seed": job["seed"],
+                     "gains": gains, "offsets": offsets, "snr_db": snr, "length": max_length}
+
+# Read a mixture manifest into {mixture_id: record}; failed mixtures only with include_failed
+def load_mixture_manifest(output_dir, include_failed=False):
+    manifest_path = os.path.join(output_dir, "manifest.jsonl")
+    records = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r") as f:
+            for line in f:
+                if line.endswith("\n"):
+                    record = json.loads(line)
+                    # The last record of an id wins; a later failure also hides an earlier render
+                    if include_failed or not record.get("failed"):
+                        records[record["mixture_id"]] = record
+                    else:
+                        records.pop(record["mixture_id"], None)
+    return records
+
+# Create mixtures on a spawn-started process pool and append their records to
+# output_dir/manifest.jsonl, one write per batch of write_batch mixtures. The workers only run
+# torchaudio.load and torchaudio.save (library functions, which spawn can import); the parent
+# crops, mixes and builds the records. A mixture whose decode, render or save raises gets a
+# {"mixture_id", "failed", "error"} record instead of stopping the run. A mixture is skipped only
+# when its manifest record matches the current plan (speakers, sources, render seed, length);
+# failed ones and ones planned differently (another seed or speaker list) are re-rendered, and
+# the newer record supersedes the old one, so an interrupted run resumes.
+def create_mixtures(ids, files_dict, output_dir, num_mixtures=100, seed=0, num_workers=None, write_batch=256):
+    done = load_mixture_manifest(output_dir)
+
+    def up_to_date(job):
+        record = done.get(job["mixture_id"])
+        return record is not None and [record["speakers"], record["sources"], record.get("seed"), record["length"]] == \
+            [job["speakers"], job["sources"], job["seed"], job["max_length"]]
+
+    jobs = [job for job in plan_mixtures(ids, files_dict, output_dir, num_mixtures, seed) if not up_to_date(job)]
+    num_workers = num_workers or os.cpu_count() or 1
+
+    def failure(job, error):
+        return {"mixture_id": job["mixture_id"], "sources": job["sources"], "failed": True, "error": repr(error)}
+
+    num_failed = 0
+    with ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=torch.set_num_threads, initargs=(1,)) as pool, \
+            open(os.path.join(output_dir, "manifest.jsonl"), "a") as manifest, tqdm(total=len(jobs)) as progress:
+        for start in range(0, len(jobs), write_batch):
+            batch = jobs[start:start + write_batch]
+            loads = [[pool.submit(torchaudio.load, path) for path in job["sources"]] for job in batch]
+            records, saves = [], []
+            for job, futures in zip(batch, loads):
+                try:
+                    outputs, record = render_mixture(job, [resample(*future.result()).mean(dim=0) for future in futures])
+                    saves.append((job, record, [pool.submit(torchaudio.save, path, waveform.unsqueeze(0), 16000)
+                                                for path, waveform in outputs]))
+                except Exception as e:
+                    records.append(failure(job, e))
+            for job, record, futures in saves:
+                try:
+                    for future in futures:
+                        future.result()
+                    records.append(record)
+                except Exception as e:
+                    records.append(failure(job, e))
+            num_failed += sum(1 for record in records if record.get("failed"))
+            manifest.writelines(json.dumps(record) + "\n" for record in sorted(records, key=lambda r: r["mixture_id"]))
+            manifest.flush()
+            progress.update(len(batch))
+    if num_failed:
+        print(f"{num_failed} mixtures failed in {output_dir}; see the failed records in manifest.jsonl")
 
 # Generate datasets
 train_files = collect_files(train_ids, voxceleb2_root)
@@ -410,6 +1855,8 @@ from pystoi import stoi
 import numpy as np
 from tqdm import tqdm
 import os
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import multiprocessing
 
 # Load pre-trained SepFormer model
 model = SepformerSeparation.from_hparams(
@@ -417,82 +1864,356 @@ model = SepformerSeparation.from_hparams(
     savedir="pretrained_models/sepformer-wsj02mix"
 )
 
-# Evaluation metrics functions
-def compute_sdr(ref, est):
-    """Simplified SDR calculation"""
-    s_target = ref
-    e_noise = est - ref
-    return 10 * np.log10(np.mean(s_target**2) / (np.mean(e_noise**2) + 1e-8))
-
-def compute_sir(ref, est, interferer):
-    """Simplified SIR calculation"""
-    s_target = ref
-    e_interf = interferer
-    return 10 * np.log10(np.mean(s_target**2) / (np.mean(e_interf**2) + 1e-8))
-
-def compute_sar(ref, est):
-    """Simplified SAR calculation"""
-    s_target = ref
-    e_artifacts = est - ref
-    return 10 * np.log10(np.mean(s_target**2) / (np.mean(e_artifacts**2) + 1e-8))
+# Evaluation metrics: batched, differentiable separation metrics over [batch, sources, samples]
+# tensors. Signals are trimmed to a common length, masked to each utterance's valid samples and
+# zero-meaned. Estimates are decomposed BSS-eval style (without distortion filters):
+#   s_target = projection of the estimate onto its own reference
+#   e_interf = projection onto the span of all references, minus s_target
+#   e_artif  = the rest of the estimate
+# sdr is the plain signal-to-error ratio of the old compute_sdr; si_sdr, sir and sar come from the
+# decomposition. With pit=True each utterance's estimates are reordered to the permutation of
+# references with the best mean SI-SDR. That choice is discrete, but the metrics are gathered from
+# the reordered estimates, so gradients still reach the separator. The zero-meaned, masked copies
+# stay internal: "estimates" are the raw separator outputs, reordered and trimmed to the references,
+# for PESQ/STOI and embedding.
+def _prepare_signals(est, ref, lengths=None):
+    num_samples = min(est.size(-1), ref.size(-1))
+    est, ref = est[..., :num_samples].float(), ref[..., :num_samples].float()
+    if lengths is None:
+        mask = torch.ones(est.size(0), 1, num_samples, device=est.device)
+    else:
+        positions = torch.arange(num_samples, device=est.device)
+        mask = (positions[None, :] < lengths.to(est.device)[:, None]).float().unsqueeze(1)
+    count = mask.sum(dim=-1, keepdim=True).clamp(min=1)
+    est = (est - (est * mask).sum(dim=-1, keepdim=True) / count) * mask
+    ref = (ref - (ref * mask).sum(dim=-1, keepdim=True) / count) * mask
+    return est, ref
+
+def _energy(x):
+    return (x ** 2).sum(dim=-1)
+
+def _ratio_db(num, den, eps):
+    return 10 * torch.log10((num + eps) / (den + eps))
+
+# SI-SDR of every estimate against every reference: [batch, est, ref]
+def pairwise_si_sdr(est, ref, eps=1e-8):
+    dot = torch.einsum("bit,bjt->bij", est, ref)
+    ref_energy = _energy(ref)[:, None, :]
+    target_energy = dot ** 2 / (ref_energy + eps)
+    return _ratio_db(target_energy, _energy(est)[:, :, None] - target_energy, eps)
+
+# For each utterance, the estimate index assigned to each reference under the best permutation
+def pit_permutation(pairwise):
+    num_sources = pairwise.size(-1)
+    perms = torch.tensor(list(itertools.permutations(range(num_sources))), device=pairwise.device)
+    refs = torch.arange(num_sources, device=pairwise.device)
+    scores = pairwise[:, perms, refs].mean(dim=-1)  # [batch, permutations]
+    return perms[scores.argmax(dim=1)]
+
+def separation_metrics(est, ref, lengths=None, pit=True, eps=1e-8):
+    raw = est[..., :min(est.size(-1), ref.size(-1))]
+    est, ref = _prepare_signals(est, ref, lengths)
+    if pit:
+        permutation = pit_permutation(pairwise_si_sdr(est, ref, eps))
+        est = torch.gather(est, 1, permutation[:, :, None].expand_as(est))
+        raw = torch.gather(raw, 1, permutation[:, :, None].expand_as(raw))
+    else:
+        permutation = torch.arange(est.size(1), device=est.device).expand(est.size(0), -1)
+
+    ref_energy = _energy(ref)
+    s_target = ((est * ref).sum(dim=-1) / (ref_energy + eps))[..., None] * ref
+    gram = torch.einsum("bit,bjt->bij", ref, ref) + eps * torch.eye(ref.size(1), device=ref.device)
+    coeffs = torch.linalg.solve(gram, torch.einsum("bjt,bit->bji", ref, est))  # [batch, ref, est]
+    projection = torch.einsum("bji,bjt->bit", coeffs, ref)
+    e_interf = projection - s_target
+    e_artif = est - projection
+
+    return {
+        "si_sdr": _ratio_db(_energy(s_target), _energy(e_interf + e_artif), eps),
+        "sdr": _ratio_db(ref_energy, _energy(est - ref), eps),
+        "sir": _ratio_db(_energy(s_target), _energy(e_interf), eps),
+        "sar": _ratio_db(_energy(s_target + e_interf), _energy(e_artif), eps),
+        "permutation": permutation,
+        "estimates": raw,
+    }
+
+# Asynchronous scoring stage: submit() queues PESQ and STOI for each source of a separated
+# mixture on a spawn-started process pool and returns at once, so separation of the next
+# mixture overlaps with scoring. Only the library functions are shipped to the workers; a
+# failure (e.g. PESQ finding no speech in the reference) comes back through its future and is
+# recorded as NaN by the parent, which reports the errors on close(). At most max_pending jobs
+# are in flight (submit blocks on the oldest beyond that), results are folded in as they
+# complete, and close() waits for the rest and returns {metric: [values in key order]}.
+# Use it as a context manager so the workers are shut down on errors too.
+class ScoringPool:
+    def __init__(self, num_workers=None, max_pending=None, sample_rate=16000):
+        num_workers = num_workers or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context("spawn"),
+                                            initializer=torch.set_num_threads, initargs=(1,))
+        self.max_pending = max_pending or 4 * num_workers
+        self.sample_rate = sample_rate
+        self.pending = {}
+        self.scores = {}
+        self.metrics = {}
+        self.errors = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.executor.shutdown(wait=exc[0] is None, cancel_futures=exc[0] is not None)
+
+    def _collect(self, done):
+        for future in done:
+            key, metric, source = self.pending.pop(future)
+            try:
+                self.scores[key][metric][source] = future.result()
+            except Exception as e:
+                self.errors.append(f"{metric} failed for {key}, source {source}: {e}")
+
+    # Add metrics computed elsewhere (e.g. the batched torch metrics) under the same key
+    def record(self, key, **metrics):
+        self.metrics.setdefault(key, {}).update(metrics)
+
+    def submit(self, key, refs, ests):
+        self.scores[key] = {"PESQ": [float("nan")] * len(refs), "STOI": [float("nan")] * len(refs)}
+        for source, (ref, est) in enumerate(zip(refs, ests)):
+            for metric, job in (("PESQ", (pesq, self.sample_rate, ref, est, "wb")),
+                                ("STOI", (stoi, ref, est, self.sample_rate, False))):
+                if len(self.pending) >= self.max_pending:
+                    self._collect(wait(self.pending, return_when=FIRST_COMPLETED).done)
+                self.pending[self.executor.submit(*job)] = (key, metric, source)
+        self._collect({future for future in self.pending if future.done()})
+
+    def close(self):
+        self._collect(wait(self.pending).done)
+        self.executor.shutdown()
+        for error in self.errors:
+            print(error)
+        results = {}
+        for key in sorted(set(self.metrics) | set(self.scores)):
+            for metric, values in {**self.metrics.get(key, {}), **self.scores.get(key, {})}.items():
+                results.setdefault(metric, []).extend(values)
+        return results
+
+# Batched in-memory separation with SepformerSeparation.separate_batch. Inputs longer than
+# chunk_seconds are cut into chunks overlapping by at least overlap_seconds; chunks from all
+# inputs are length-bucketed into batches together. Each chunk's sources are then permuted to
+# best match the output built so far over their overlap (the separator's source order is
+# arbitrary per chunk) and cross-faded in with complementary linear ramps.
+# Returns one [num_sources, samples] tensor per input, in input order, on the CPU. With a
+# SeparationCache, inputs already separated by the same weights and settings are read back.
+class BatchSeparator:
+    def __init__(self, separator, chunk_seconds=8.0, overlap_seconds=1.0, max_samples_per_batch=16000 * 64,
+                 max_batch_size=16, sample_rate=16000, cache=None):
+        self.separator = separator
+        self.cache = cache
+        self.chunk = int(chunk_seconds * sample_rate)
+        self.overlap = int(overlap_seconds * sample_rate)
+        self.max_samples_per_batch = max_samples_per_batch
+        self.max_batch_size = max_batch_size
+        self.sample_rate = sample_rate
+        self.audio_seconds = 0.0
+        self.compute_seconds = 0.0
+        self.cached_seconds = 0.0
+
+    def _chunk_starts(self, length):
+        if length <= self.chunk:
+            return [0]
+        starts = list(range(0, length - self.chunk, self.chunk - self.overlap))
+        return starts + [length - self.chunk]
+
+    @staticmethod
+    def _align(tail, chunk_head):
+        # Permutation of the chunk's sources that best correlates with the output so far
+        scores = torch.einsum("it,jt->ij", F.normalize(tail, dim=1), F.normalize(chunk_head, dim=1))
+        perms = list(itertools.permutations(range(tail.size(0))))
+        return max(perms, key=lambda perm: sum(scores[i, j] for i, j in enumerate(perm)))
+
+    def __call__(self, waveforms):
+        waveforms = [torch.as_tensor(w, dtype=torch.float32).reshape(-1) for w in waveforms]
+        if self.cache is None:
+            return self._separate(waveforms)
+        # The weight digest is cached until an optimizer step or load changes a tensor in place,
+        # so fine-tuning the separator still invalidates its entries without re-hashing every call
+        identity = f"{separator_identity(self.separator)}:{self.chunk}:{self.overlap}"
+        keys = [self.cache.key(w, identity) for w in waveforms]
+        outputs = self.cache.get(keys)
+        missing = [i for i, output in enumerate(outputs) if output is None]
+        self.cached_seconds += sum(w.size(0) for w, output in zip(waveforms, outputs) if output is not None) / self.sample_rate
+        if missing:
+            separated = self._separate([waveforms[i] for i in missing])
+            self.cache.append([keys[i] for i in missing], separated)
+            for i, output in zip(missing, separated):
+                outputs[i] = output
+        return outputs
+
+    def _separate(self, waveforms):
+        start_time = time.perf_counter()
+        chunks = [(i, start, min(start + self.chunk, w.size(0)))
+                  for i, w in enumerate(waveforms) for start in self._chunk_starts(w.size(0))]
+        lengths = [end - start for _, start, end in chunks]
+        separated = [None] * len(chunks)
+        with torch.no_grad():
+            for batch in make_length_buckets(lengths, self.max_samples_per_batch, self.max_batch_size):
+                mix = torch.zeros(len(batch), max(lengths[k] for k in batch))
+                for row, k in enumerate(batch):
+                    i, start, end = chunks[k]
+                    mix[row, :end - start] = waveforms[i][start:end]
+                est = self.separator.separate_batch(mix).detach().float().cpu()  # [batch, samples, sources]
+                if est.size(1) < mix.size(1):
+                    est = F.pad(est, (0, 0, 0, mix.size(1) - est.size(1)))
+                for row, k in enumerate(batch):
+                    separated[k] = est[row, :lengths[k]].T  # [sources, samples]
+
+        outputs, k = [], 0
+        for i, w in enumerate(waveforms):
+            output = torch.zeros(separated[k].size(0), w.size(0))
+            weight = torch.zeros(w.size(0))
+            prev_end = 0
+            while k < len(chunks) and chunks[k][0] == i:
+                _, start, end = chunks[k]
+                est = separated[k]
+                ramp = torch.ones(end - start)
+                fade_in = max(prev_end - start, 0)
+                if fade_in > 0:
+                    tail = output[:, start:prev_end] / weight[start:prev_end].clamp(min=1e-8)
+                    est = est[list(self._align(tail, est[:, :fade_in]))]
+                    ramp[:fade_in] = torch.linspace(0, 1, fade_in + 2)[1:-1]
+                    # The previous chunk's tail was laid down at full weight; fade it out
+                    weight[start:prev_end] = 1 - ramp[:fade_in]
+                    output[:, start:prev_end] = tail * weight[start:prev_end]
+                output[:, start:end] += est * ramp
+                weight[start:end] += ramp
+                prev_end = end
+                k += 1
+            outputs.append(output / weight.clamp(min=1e-8))
+
+        self.audio_seconds += sum(w.size(0) for w in waveforms) / self.sample_rate
+        self.compute_seconds += time.perf_counter() - start_time
+        return outputs
+
+    @property
+    def rtf(self):
+        return self.compute_seconds / max(self.audio_seconds, 1e-9)
+
+    def report(self, prefix=""):
+        print(f"{prefix}separated {self.audio_seconds:.1f}s of audio in {self.compute_seconds:.1f}s "
+              f"(RTF {self.rtf:.3f}, {1 / max(self.rtf, 1e-9):.1f}x real time), {self.cached_seconds:.1f}s from cache")
+
+# Identity of a separator's weights for separation-cache keys (state_dict_digests caches the
+# digest per weight version)
+def separator_identity(separator):
+    return f"{type(separator).__name__}:{state_dict_digests(separator)[0]}"
+
+# Persistent cache of separated sources, keyed by a hash of the mixture samples and the separator
+# identity. Outputs are stored as float32 exactly as the separator returned them, appended to
+# shard files of up to shard_bytes, with the same append-only index.jsonl and file_lock protocol
+# as EmbeddingStore (data before index line, so readers never lock). Entries for old weights are
+# simply never looked up again; delete the directory to reclaim their space.
+class SeparationCache:
+    def __init__(self, root, shard_bytes=1 << 30):
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.shard_bytes = shard_bytes
+        self.index_path = os.path.join(root, "index.jsonl")
+        self.lock_path = os.path.join(root, "cache.lock")
+        self.index = {}
+        self._index_offset = 0
+        open(self.index_path, "a").close()
+        self.refresh()
+
+    def refresh(self):
+        with open(self.index_path, "r") as f:
+            f.seek(self._index_offset)
+            for line in f:
+                if not line.endswith("\n"):
+                    break  # a writer is still appending this line
+                self._index_offset += len(line.encode())
+                record = json.loads(line)
+                self.index[record["key"]] = record
+
+    @staticmethod
+    def key(waveform, identity):
+        digest = hashlib.sha1(waveform.detach().float().cpu().contiguous().numpy().tobytes())
+        return f"{digest.hexdigest()}:{identity}"
+
+    def get(self, keys):
+        self.refresh()
+        outputs = []
+        for key in keys:
+            record = self.index.get(key)
+            if record is None:
+                outputs.append(None)
+                continue
+            shape = (record["sources"], record["samples"])
+            sources = np.memmap(os.path.join(self.root, record["shard"]), dtype=np.float32, mode="r",
+                                offset=record["offset"], shape=shape)
+            outputs.append(torch.from_numpy(np.array(sources)))
+        return outputs
+
+    def append(self, keys, outputs):
+        with file_lock(self.lock_path):
+            self.refresh()
+            shards = sorted(f for f in os.listdir(self.root) if f.startswith("sources-") and f.endswith(".f32"))
+            shard = shards[-1] if shards else f"sources-{int(time.time() * 1e6)}.f32"
+            records = []
+            for key, output in zip(keys, outputs):
+                path = os.path.join(self.root, shard)
+                if os.path.exists(path) and os.path.getsize(path) > self.shard_bytes:
+                    shard = f"sources-{int(time.time() * 1e6)}.f32"
+                    path = os.path.join(self.root, shard)
+                output = np.ascontiguousarray(output.detach().float().cpu().numpy())
+                with open(path, "ab") as f:
+                    offset = f.tell()
+                    f.write(output.tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+                records.append({"key": key, "shard": shard, "offset": offset, "sources": output.shape[0],
+                                "samples": output.shape[1]})
+            with open(self.index_path, "a") as f:
+                f.writelines(json.dumps(record) + "\n" for record in records)
+                f.flush()
+                os.fsync(f.fileno())
+        self.refresh()
 
 # Paths
 test_dir = "/content/drive/MyDrive/Colab Notebooks/SEM03-Assignments/Speech Understanding/Assignment2/output/test_mixtures"
-
-# Evaluate on test set
-results = {"SIR": [], "SAR": [], "SDR": [], "PESQ": []}
-for i in tqdm(range(50)):  # 50 test mixtures
-    mix_path = os.path.join(test_dir, f"mix_{i}.wav")
-    src1_path = os.path.join(test_dir, f"src1_{i}.wav")
-    src2_path = os.path.join(test_dir, f"src2_{i}.wav")
-
-    # Load mixture and references
-    mixture, sr = torchaudio.load(mix_path)
-    ref1, _ = torchaudio.load(src1_path)
-    ref2, _ = torchaudio.load(src2_path)
-    mixture = mixture.squeeze(0).numpy()
-    ref1 = ref1.squeeze(0).numpy()
-    ref2 = ref2.squeeze(0).numpy()
-
-    print(f"Mixture length: {mixture.shape[0]} samples ({mixture.shape[0]/16000:.2f}s)")
-
-    # Perform separation
-    est_sources = model.separate_file(mix_path)
-    est_sources = est_sources.squeeze(0).detach().cpu().numpy()
-    print(f"Est sources shape: {est_sources.shape}")
-
-    # Validate shape
-    if len(est_sources.shape) != 2 or est_sources.shape[1] != 2:
-        raise ValueError(f"Expected [samples, 2], got {est_sources.shape}")
-
-    est1, est2 = est_sources[:, 0], est_sources[:, 1]
-    print(f"Est1 shape: {est1.shape}, Est2 shape: {est2.shape}")
-
-    # Adjust lengths to match estimated sources
-    min_len = min(est1.shape[0], ref1.shape[0])
-    est1, est2 = est1[:min_len], est2[:min_len]
-    ref1, ref2 = ref1[:min_len], ref2[:min_len]
-    print(f"Adjusted lengths to {min_len} samples ({min_len/16000:.2f}s)")
-
-    # Compute metrics
-    sir1 = compute_sir(ref1, est1, ref2)
-    sir2 = compute_sir(ref2, est2, ref1)
-    sar1 = compute_sar(ref1, est1)
-    sar2 = compute_sar(ref2, est2)
-    sdr1 = compute_sdr(ref1, est1)
-    sdr2 = compute_sdr(ref2, est2)
-    pesq1 = pesq(16000, ref1, est1, "wb")
-    pesq2 = pesq(16000, ref2, est2, "wb")
-
-    # Store results
-    results["SIR"].extend([sir1, sir2])
-    results["SAR"].extend([sar1, sar2])
-    results["SDR"].extend([sdr1, sdr2])
-    results["PESQ"].extend([pesq1, pesq2])
+separation_cache = SeparationCache("/content/drive/MyDrive/Colab Notebooks/SEM03-Assignments/Speech Understanding/Assignment2/separation_cache")
+
+# Evaluate on test set: mixtures are separated in batches while PESQ/STOI for the previous
+# batch run on the scoring pool
+separator = BatchSeparator(model, cache=separation_cache)
+eval_start = time.perf_counter()
+mixture_ids = sorted(load_mixture_manifest(test_dir))  # rendered test mixtures (failed ones are skipped)
+with ScoringPool() as scorer:
+    for group_start in tqdm(range(0, len(mixture_ids), 8)):
+        group = mixture_ids[group_start:group_start + 8]
+
+        # Load mixtures and references
+        mixtures = [torchaudio.load(os.path.join(test_dir, f"mix_{i}.wav"))[0].squeeze(0) for i in group]
+        refs = [torch.cat([torchaudio.load(os.path.join(test_dir, f"src{k}_{i}.wav"))[0] for k in (1, 2)]) for i in group]
+
+        # Perform separation
+        separated = separator(mixtures)
+
+        # Compute metrics (estimates reordered to the references, trimmed to the shorter length)
+        for i, est, ref in zip(group, separated, refs):
+            metrics = separation_metrics(est.unsqueeze(0), ref.unsqueeze(0))
+            ests = metrics["estimates"][0].numpy()
+
+            # Store results; PESQ/STOI are queued and computed in the background
+            scorer.record(i, SIR=metrics["sir"][0].tolist(), SAR=metrics["sar"][0].tolist(),
+                          SDR=metrics["sdr"][0].tolist(), **{"SI-SDR": metrics["si_sdr"][0].tolist()})
+            scorer.submit(i, ref[:, :ests.shape[1]].numpy(), ests)
+
+    results = scorer.close()
+separator.report("SepFormer: ")
+print(f"Separation: {separator.compute_seconds:.1f}s, evaluation wall time: {time.perf_counter() - eval_start:.1f}s")
 
 # Compute averages
 for metric in results:
-    avg = np.mean(results[metric])
+    avg = np.nanmean(results[metric])
     print(f"Average {metric}: {avg:.2f}")
 
 """# Q. III B"""
@@ -509,17 +2230,17 @@ import os
 from peft import LoraConfig, get_peft_model
 import torch.nn as nn
 import torch.nn.functional as F
+from scipy.optimize import linear_sum_assignment
 
 # Set device
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-# Load pre-trained WavLM and feature extractor
+# Load input normalisation settings
 model_name = "microsoft/wavlm-base-plus"
-feature_extractor = Wav2Vec2FeatureExtractor.from_pretrained(model_name)
-pretrained_model = WavLMModel.from_pretrained(model_name).to(device)
-pretrained_model.eval()
+wavlm_inputs = WavLMInputNormalizer.from_feature_extractor(Wav2Vec2FeatureExtractor.from_pretrained(model_name))
 
-# Load fine-tuned WavLM (assuming saved from first task)
+# Load fine-tuned WavLM (assuming saved from first task); its base weights double as the
+# pre-trained model by switching the LoRA adapters off
 finetuned_model = WavLMModel.from_pretrained(model_name).to(device)
 lora_config = LoraConfig(
     r=32,
@@ -532,6 +2253,7 @@ finetuned_model = get_peft_model(finetuned_model, lora_config)
 # Load fine-tuned weights (update path to your saved model)
 finetuned_model.load_state_dict(torch.load("/content/drive/MyDrive/Colab Notebooks/SEM03-Assignments/Speech Understanding/Assignment2/finetuned_model.pth"))
 finetuned_model.eval()
+dual_model = DualWavLMEmbedder(finetuned_model).eval()
 
 # Load SepFormer model
 sep_model = SepformerSeparation.from_hparams(
@@ -542,93 +2264,100 @@ sep_model = SepformerSeparation.from_hparams(
 # Paths
 test_dir = "/content/drive/MyDrive/Colab Notebooks/SEM03-Assignments/Speech Understanding/Assignment2/output/test_mixtures"
 voxceleb2_root = "/content/drive/MyDrive/Colab Notebooks/SEM03-Assignments/Speech Understanding/Assignment2/vox2/aac"
+embedding_store = EmbeddingStore("/content/drive/MyDrive/Colab Notebooks/SEM03-Assignments/Speech Understanding/Assignment2/embedding_store")
+separation_cache = SeparationCache("/content/drive/MyDrive/Colab Notebooks/SEM03-Assignments/Speech Understanding/Assignment2/separation_cache")
 
 # Test identities (50-99)
-all_ids = sorted([d for d in os.listdir(voxceleb2_root) if os.path.isdir(os.path.join(voxceleb2_root, d))])
+all_ids = open_file_index(voxceleb2_root).speakers()
 test_ids = all_ids[50:100]
 id_to_idx = {id: idx for idx, id in enumerate(test_ids)}
 
 # Function to extract embedding
 def extract_embedding(waveform, model):
-    inputs = feature_extractor(waveform.tolist(), sampling_rate=16000, return_tensors="pt", padding=True)
-    input_values = inputs["input_values"].to(device)
-    with torch.no_grad():
-        outputs = model(input_values)
-        embedding = outputs.last_hidden_state.mean(dim=1).squeeze().cpu().numpy()
-    return embedding
+    return next(extract_embeddings_batched([waveform], model))
+
+# Speaker gallery: L2-normalised reference embeddings in one contiguous [speakers, dim] matrix on
+# the device. search() scores any number of query streams with one matmul and returns the top-k
+# speakers per stream. assign() picks distinct speakers for the streams of one mixture by solving
+# the assignment problem (linear_sum_assignment) over the union of each stream's top-S candidates,
+# with S the number of streams. That is always optimal: a stream assigned outside its own top-S
+# could swap to one of its top-S columns left free by the other S-1 streams and score higher.
+class GalleryIndex:
+    def __init__(self, ids, embeddings, device=device):
+        self.ids = list(ids)
+        self.matrix = F.normalize(torch.as_tensor(np.asarray(embeddings), dtype=torch.float32), dim=1).to(device).contiguous()
 
-# Cosine similarity
-cosine_similarity = nn.CosineSimilarity(dim=0, eps=1e-6)
+    def __len__(self):
+        return len(self.ids)
+
+    def _queries(self, queries):
+        queries = torch.as_tensor(np.asarray(queries), dtype=torch.float32, device=self.matrix.device)
+        return F.normalize(queries.reshape(-1, self.matrix.size(1)), dim=1)
+
+    # Top-k (cosine score, gallery row) for each query; queries is [..., dim]
+    def search_rows(self, queries, k=5):
+        with torch.no_grad():
+            scores, rows = (self._queries(queries) @ self.matrix.T).topk(min(k, len(self)), dim=1)
+        return scores.cpu().numpy(), rows.cpu().numpy()
+
+    def search(self, queries, k=5):
+        scores, rows = self.search_rows(queries, k)
+        return scores, [[self.ids[r] for r in row] for row in rows]
+
+    # Joint assignment for a batch of mixtures: queries is [mixtures, streams, dim]; returns the
+    # assigned speaker ids [mixtures][streams] and their scores
+    def assign(self, queries):
+        queries = np.asarray(queries)
+        num_mixtures, num_streams = queries.shape[:2]
+        with torch.no_grad():
+            q = self._queries(queries).reshape(num_mixtures, num_streams, -1)
+            _, rows = (q @ self.matrix.T).topk(min(num_streams, len(self)), dim=2)
+            candidates = rows.reshape(num_mixtures, -1)
+            scores = torch.einsum("msd,mcd->msc", q, self.matrix[candidates]).cpu().numpy()
+        candidates = candidates.cpu().numpy()
+        assigned, assigned_scores = [], []
+        for m in range(num_mixtures):
+            # Streams often share candidates; keep one column per speaker so none is assigned twice
+            rows_m, first = np.unique(candidates[m], return_index=True)
+            stream_rows, cols = linear_sum_assignment(scores[m][:, first], maximize=True)
+            order = np.argsort(stream_rows)
+            assigned.append([self.ids[rows_m[c]] for c in cols[order]])
+            assigned_scores.append(scores[m][:, first][stream_rows[order], cols[order]])
+        return assigned, np.asarray(assigned_scores)
 
 # Collect reference embeddings for test identities
-ref_embeddings_pretrained = {}
-ref_embeddings_finetuned = {}
-for speaker_id in test_ids:
-    speaker_path = os.path.join(voxceleb2_root, speaker_id, os.listdir(os.path.join(voxceleb2_root, speaker_id))[0])
-    file = os.path.join(speaker_path, os.listdir(speaker_path)[0])
-    waveform, sr = torchaudio.load(file)
-    if sr != 16000:
-        waveform = torchaudio.transforms.Resample(sr, 16000)(waveform)
-    waveform = waveform.squeeze(0).numpy()
-
-    ref_embeddings_pretrained[speaker_id] = extract_embedding(waveform, pretrained_model)
-    ref_embeddings_finetuned[speaker_id] = extract_embedding(waveform, finetuned_model)
+ref_files = [open_file_index(voxceleb2_root).first_file(speaker_id) for speaker_id in test_ids]
+
+ref_pretrained, ref_finetuned = embedding_store.embed_files(ref_files, dual_model)
+gallery_pretrained = GalleryIndex(test_ids, ref_pretrained)
+gallery_finetuned = GalleryIndex(test_ids, ref_finetuned)
 
 # Evaluate on separated test set
 correct_pretrained = 0
 correct_finetuned = 0
 total = 0
 
-for i in tqdm(range(50)):  # 50 test mixtures
-    mix_path = os.path.join(test_dir, f"mix_{i}.wav")
-    src1_path = os.path.join(test_dir, f"src1_{i}.wav")
-    src2_path = os.path.join(test_dir, f"src2_{i}.wav")
-
-    # Ground truth speaker IDs
-    src1_file = os.path.basename(src1_path).split("_")[1]
-    src2_file = os.path.basename(src2_path).split("_")[1]
-    true_id1 = os.path.basename(os.path.dirname(os.path.dirname(src1_path)))
-    true_id2 = os.path.basename(os.path.dirname(os.path.dirname(src2_path)))
-
-    # Separation
-    est_sources = sep_model.separate_file(mix_path).squeeze(0).detach().cpu().numpy()
-    est1, est2 = est_sources[:, 0], est_sources[:, 1]
-
-    # Extract embeddings from separated sources
-    emb1_pretrained = extract_embedding(est1, pretrained_model)
-    emb2_pretrained = extract_embedding(est2, pretrained_model)
-    emb1_finetuned = extract_embedding(est1, finetuned_model)
-    emb2_finetuned = extract_embedding(est2, finetuned_model)
-
-    # Compute similarities and predict speakers
-    pretrained_scores = {}
-    finetuned_scores = {}
-    for speaker_id in test_ids:
-        ref_pre = torch.from_numpy(ref_embeddings_pretrained[speaker_id]).to(device)
-        ref_fin = torch.from_numpy(ref_embeddings_finetuned[speaker_id]).to(device)
-        pretrained_scores[speaker_id] = [
-            cosine_similarity(torch.from_numpy(emb1_pretrained).to(device), ref_pre).item(),
-            cosine_similarity(torch.from_numpy(emb2_pretrained).to(device), ref_pre).item()
-        ]
-        finetuned_scores[speaker_id] = [
-            cosine_similarity(torch.from_numpy(emb1_finetuned).to(device), ref_fin).item(),
-            cosine_similarity(torch.from_numpy(emb2_finetuned).to(device), ref_fin).item()
-        ]
-
-    # Rank-1 prediction
-    pred_id1_pre = max(pretrained_scores, key=lambda k: pretrained_scores[k][0])
-    pred_id2_pre = max(pretrained_scores, key=lambda k: pretrained_scores[k][1])
-    pred_id1_fin = max(finetuned_scores, key=lambda k: finetuned_scores[k][0])
-    pred_id2_fin = max(finetuned_scores, key=lambda k: finetuned_scores[k][1])
-
-    # Check correctness (permutation invariant)
-    pre_correct = (pred_id1_pre == true_id1 and pred_id2_pre == true_id2) or \
-                  (pred_id1_pre == true_id2 and pred_id2_pre == true_id1)
-    fin_correct = (pred_id1_fin == true_id1 and pred_id2_fin == true_id2) or \
-                  (pred_id1_fin == true_id2 and pred_id2_fin == true_id1)
-
-    correct_pretrained += pre_correct
-    correct_finetuned += fin_correct
+test_manifest = load_mixture_manifest(test_dir)
+test_mixture_ids = sorted(test_manifest)  # failed mixtures have no record here and are skipped
+
+# Separation: all test mixtures in length-bucketed batches (or from the separation cache)
+sep_separator = BatchSeparator(sep_model, cache=separation_cache)
+separated = sep_separator([torchaudio.load(os.path.join(test_dir, f"mix_{i}.wav"))[0].squeeze(0) for i in test_mixture_ids])
+sep_separator.report("SepFormer: ")
+
+# Extract embeddings from all separated sources at once: [mixture, stream, (pre-trained, fine-tuned), dim]
+stream_embeddings = np.stack(list(extract_embeddings_batched([source for est in separated for source in est], dual_model)))
+stream_embeddings = stream_embeddings.reshape(len(separated), 2, 2, -1)
+
+# Joint rank-1 prediction: the two streams of a mixture get distinct speakers
+pred_pretrained, _ = gallery_pretrained.assign(stream_embeddings[:, :, 0])
+pred_finetuned, _ = gallery_finetuned.assign(stream_embeddings[:, :, 1])
+
+for row, i in enumerate(test_mixture_ids):
+    # Ground truth speaker IDs from the mixture manifest; correctness is permutation invariant
+    true_ids = sorted(test_manifest[i]["speakers"])
+    correct_pretrained += sorted(pred_pretrained[row]) == true_ids
+    correct_finetuned += sorted(pred_finetuned[row]) == true_ids
     total += 1
 
 # Compute Rank-1 accuracy
@@ -638,6 +2367,373 @@ rank1_acc_finetuned = correct_finetuned / total * 100
 print(f"Pre-trained WavLM Rank-1 Accuracy: {rank1_acc_pretrained:.2f}%")
 print(f"Fine-tuned WavLM Rank-1 Accuracy: {rank1_acc_finetuned:.2f}%")
 
+"""**Approximate index for large galleries**"""
+
+# IVF-PQ speaker index in NumPy, an approximate alternative to GalleryIndex for galleries too
+# large for a dense float32 matrix. Normalised embeddings are assigned to the nearest of num_lists
+# coarse centroids (inverted lists); the residual to that centroid is product-quantised into
+# num_subspaces one-byte codes (64 bytes per speaker instead of 3 KB). A query probes the nprobe
+# lists with the highest centroid score and scores their entries by asymmetric distance
+# computation: q.c + sum over subspaces of q_m.codebook_m[code_m], from per-query lookup tables.
+# Entries are kept in a CSR layout sorted by list (saved as .npy and memory-mapped on load);
+# add() appends to in-memory delta chunks and remove() clears an alive flag until merge().
+class IVFPQIndex:
+    def __init__(self, dim=768, num_lists=1024, num_subspaces=64, num_codes=256, nprobe=32, seed=0):
+        assert dim % num_subspaces == 0 and num_codes <= 256
+        self.dim = dim
+        self.num_lists = num_lists
+        self.num_subspaces = num_subspaces
+        self.num_codes = num_codes
+        self.nprobe = nprobe
+        self.seed = seed
+        self.centroids = None
+        self.codebooks = None
+        self.ids = []
+        self.row_of = {}
+        self.alive = np.zeros(0, dtype=bool)
+        self.base_codes = np.zeros((0, num_subspaces), dtype=np.uint8)
+        self.base_rows = np.zeros(0, dtype=np.int64)
+        self.offsets = np.zeros(num_lists + 1, dtype=np.int64)
+        self._delta = []  # (lists, rows, codes) chunks added since the last merge
+
+    def __len__(self):
+        return len(self.row_of)
+
+    @staticmethod
+    def _normalize(x):
+        x = np.asarray(x, dtype=np.float32).reshape(len(x), -1)
+        return x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-8)
+
+    @staticmethod
+    def _nearest(x, centroids, chunk_size=65536):
+        half_norms = 0.5 * (centroids ** 2).sum(axis=1)
+        return np.concatenate([np.argmax(x[i:i + chunk_size] @ centroids.T - half_norms, axis=1)
+                               for i in range(0, len(x), chunk_size)]) if len(x) else np.zeros(0, dtype=np.int64)
+
+    @classmethod
+    def _kmeans(cls, x, k, iterations, rng):
+        centroids = x[rng.choice(len(x), k, replace=len(x) < k)].copy()
+        for _ in range(iterations):
+            assignment = cls._nearest(x, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, x)
+            counts = np.bincount(assignment, minlength=k)
+            empty = counts == 0
+            centroids[~empty] = sums[~empty] / counts[~empty, None]
+            centroids[empty] = x[rng.choice(len(x), int(empty.sum()))]  # reseed empty clusters
+        return centroids
+
+    # Learn coarse centroids and residual codebooks from a sample of embeddings
+    def train(self, embeddings, iterations=20, max_samples=200_000):
+        rng = np.random.default_rng(self.seed)
+        x = self._normalize(embeddings)
+        if len(x) > max_samples:
+            x = x[rng.choice(len(x), max_samples, replace=False)]
+        self.num_lists = min(self.num_lists, len(x))
+        self.centroids = self._kmeans(x, self.num_lists, iterations, rng)
+        residuals = x - self.centroids[self._nearest(x, self.centroids)]
+        sub = residuals.reshape(len(x), self.num_subspaces, -1)
+        self.codebooks = np.stack([self._kmeans(sub[:, m], min(self.num_codes, len(x)), iterations, rng)
+                                   for m in range(self.num_subspaces)])
+        self.offsets = np.zeros(self.num_lists + 1, dtype=np.int64)
+        return self
+
+    def _encode(self, x):
+        lists = self._nearest(x, self.centroids)
+        sub = (x - self.centroids[lists]).reshape(len(x), self.num_subspaces, -1)
+        codes = np.stack([self._nearest(sub[:, m], self.codebooks[m]) for m in range(self.num_subspaces)], axis=1)
+        return lists, codes.astype(np.uint8)
+
+    # Enrol (or re-enrol) speakers
+    def add(self, ids, embeddings):
+        ids = list(ids)
+        self.remove([speaker_id for speaker_id in ids if speaker_id in self.row_of])
+        lists, codes = self._encode(self._normalize(embeddings))
+        rows = np.arange(len(self.ids), len(self.ids) + len(ids))
+        self.ids.extend(ids)
+        self.row_of.update(zip(ids, rows.tolist()))
+        self.alive = np.concatenate([self.alive, np.ones(len(ids), dtype=bool)])
+        self._delta.append((lists, rows, codes))
+
+    def remove(self, ids):
+        for speaker_id in ids:
+            self.alive[self.row_of.pop(speaker_id)] = False
+
+    # Fold delta chunks into the sorted CSR arrays and drop removed entries (renumbers rows)
+    def merge(self):
+        list_of_base = np.repeat(np.arange(self.num_lists), np.diff(self.offsets))
+        lists = np.concatenate([list_of_base] + [d[0] for d in self._delta])
+        rows = np.concatenate([self.base_rows] + [d[1] for d in self._delta])
+        codes = np.concatenate([np.asarray(self.base_codes)] + [d[2] for d in self._delta])
+        keep = self.alive[rows]
+        lists, rows, codes = lists[keep], rows[keep], codes[keep]
+        order = np.argsort(lists, kind="stable")
+        new_row = np.full(len(self.ids), -1, dtype=np.int64)
+        new_row[rows[order]] = np.arange(len(order))
+        self.ids = [self.ids[r] for r in rows[order]]
+        self.row_of = {speaker_id: row for row, speaker_id in enumerate(self.ids)}
+        self.alive = np.ones(len(self.ids), dtype=bool)
+        self.base_rows = new_row[rows[order]]
+        self.base_codes = codes[order]
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(lists, minlength=self.num_lists))])
+        self._delta = []
+
+    def save(self, directory):
+        self.merge()
+        os.makedirs(directory, exist_ok=True)
+        for name in ("centroids", "codebooks", "base_codes", "base_rows", "offsets"):
+            np.save(os.path.join(directory, f"{name}.npy"), getattr(self, name))
+        meta = {"dim": self.dim, "num_subspaces": self.num_subspaces, "num_codes": self.num_codes,
+                "nprobe": self.nprobe, "seed": self.seed, "ids": self.ids}
+        with open(os.path.join(directory, "index.json"), "w") as f:
+            json.dump(meta, f)
+
+    # Codes and row arrays are memory-mapped, so opening a large index reads only the metadata
+    @classmethod
+    def load(cls, directory, mmap=True):
+        with open(os.path.join(directory, "index.json"), "r") as f:
+            meta = json.load(f)
+        arrays = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r" if mmap else None)
+                  for name in ("centroids", "codebooks", "base_codes", "base_rows", "offsets")}
+        index = cls(meta["dim"], len(arrays["centroids"]), meta["num_subspaces"], meta["num_codes"],
+                    meta["nprobe"], meta["seed"])
+        for name, array in arrays.items():
+            setattr(index, name, array)
+        index.centroids, index.codebooks = np.asarray(index.centroids), np.asarray(index.codebooks)
+        index.ids = meta["ids"]
+        index.row_of = {speaker_id: row for row, speaker_id in enumerate(index.ids)}
+        index.alive = np.ones(len(index.ids), dtype=bool)
+        return index
+
+    # ADC scores of several queries against every live entry of the given lists: (rows, [queries, rows])
+    def _probe(self, q, coarse, lists):
+        tables = np.einsum("qmd,mkd->qmk", q.reshape(len(q), self.num_subspaces, -1), self.codebooks)
+        subspaces = np.arange(self.num_subspaces)
+        entry_lists, rows, codes = [], [], []
+        for l in lists:
+            a, b = self.offsets[l], self.offsets[l + 1]
+            entry_lists.append(np.full(b - a, l))
+            rows.append(self.base_rows[a:b])
+            codes.append(np.asarray(self.base_codes[a:b]))
+        for d_lists, d_rows, d_codes in self._delta:
+            mask = np.isin(d_lists, lists)
+            entry_lists.append(d_lists[mask])
+            rows.append(d_rows[mask])
+            codes.append(d_codes[mask])
+        entry_lists, rows, codes = np.concatenate(entry_lists), np.concatenate(rows), np.concatenate(codes)
+        keep = self.alive[rows]
+        entry_lists, rows, codes = entry_lists[keep], rows[keep], codes[keep]
+        scores = coarse[:, entry_lists] + tables[:, subspaces, codes].sum(axis=2)
+        return rows, scores
+
+    def _probe_lists(self, coarse, nprobe):
+        nprobe = min(nprobe or self.nprobe, self.num_lists)
+        return np.argpartition(-coarse, nprobe - 1, axis=1)[:, :nprobe]
+
+    # Same interface as GalleryIndex.search: top-k (approximate cosine, speaker id) per query
+    def search(self, queries, k=5, nprobe=None):
+        q = self._normalize(queries)
+        coarse = q @ self.centroids.T
+        probes = self._probe_lists(coarse, nprobe)
+        all_scores = np.full((len(q), k), -np.inf, dtype=np.float32)
+        all_ids = []
+        for i in range(len(q)):
+            rows, scores = self._probe(q[i:i + 1], coarse[i:i + 1], probes[i])
+            top = np.argsort(-scores[0])[:k]
+            all_scores[i, :len(top)] = scores[0, top]
+            all_ids.append([self.ids[r] for r in rows[top]])
+        return all_scores, all_ids
+
+    # Same interface as GalleryIndex.assign: the streams of a mixture probe the union of their
+    # lists, so every stream has an ADC score for every candidate, and distinct speakers are chosen
+    # by linear_sum_assignment over the union of the streams' top-S candidates
+    def assign(self, queries, nprobe=None):
+        queries = np.asarray(queries)
+        num_mixtures, num_streams = queries.shape[:2]
+        assigned, assigned_scores = [], []
+        for m in range(num_mixtures):
+            q = self._normalize(queries[m])
+            coarse = q @ self.centroids.T
+            rows, scores = self._probe(q, coarse, np.unique(self._probe_lists(coarse, nprobe)))
+            candidates = np.unique(np.argsort(-scores, axis=1)[:, :num_streams])
+            stream_rows, cols = linear_sum_assignment(scores[:, candidates], maximize=True)
+            order = np.argsort(stream_rows)
+            assigned.append([self.ids[rows[candidates[c]]] for c in cols[order]])
+            assigned_scores.append(scores[:, candidates][stream_rows[order], cols[order]])
+        return assigned, np.asarray(assigned_scores)
+
+# Recall@k of IVF-PQ against exact GalleryIndex search, and queries per second, for several nprobe
+def benchmark_ann(index, exact, queries, k=10, nprobes=(1, 4, 16, 64)):
+    start = time.perf_counter()
+    _, exact_ids = exact.search(queries, k)
+    exact_qps = len(queries) / (time.perf_counter() - start)
+    print(f"Exact: {exact_qps:.0f} QPS over {len(exact)} speakers")
+    results = {"exact_qps": exact_qps}
+    for nprobe in nprobes:
+        start = time.perf_counter()
+        _, approx_ids = index.search(queries, k, nprobe=nprobe)
+        qps = len(queries) / (time.perf_counter() - start)
+        recall = np.mean([len(set(a) & set(e)) / len(e) for a, e in zip(approx_ids, exact_ids)])
+        print(f"IVF-PQ nprobe={nprobe}: recall@{k} {recall:.3f}, {qps:.0f} QPS")
+        results[nprobe] = {"recall": recall, "qps": qps}
+    return results
+
+# Enrol every VoxCeleb2 speaker (first utterance, fine-tuned embeddings) and query with the separated
+# test streams; the index round-trips through disk and is searched from the memory-mapped copy
+enrol_ids = open_file_index(voxceleb2_root).speakers()
+_, enrol_embeddings = embedding_store.embed_files([open_file_index(voxceleb2_root).first_file(speaker_id) for speaker_id in enrol_ids], dual_model)
+ann_dir = "/content/drive/MyDrive/Colab Notebooks/SEM03-Assignments/Speech Understanding/Assignment2/ivfpq_index"
+ann_index = IVFPQIndex(num_lists=max(1, int(np.sqrt(len(enrol_ids))))).train(enrol_embeddings)
+ann_index.add(enrol_ids, enrol_embeddings)
+ann_index.save(ann_dir)
+ann_index = IVFPQIndex.load(ann_dir)
+ann_results = benchmark_ann(ann_index, GalleryIndex(enrol_ids, enrol_embeddings), stream_embeddings[:, :, 1].reshape(-1, 768))
+
+"""**Streaming mode**"""
+
+# Fixed-capacity circular buffer over the last `capacity` samples of a [channels, samples] stream,
+# addressed by absolute sample position
+class RingBuffer:
+    def __init__(self, capacity, channels=1):
+        self.buffer = torch.zeros(channels, capacity)
+        self.capacity = capacity
+        self.written = 0
+
+    def write(self, samples):
+        samples = samples.reshape(self.buffer.size(0), -1)
+        num_samples = samples.size(1)
+        samples = samples[:, -self.capacity:]  # older samples would be overwritten anyway
+        pos = (self.written + num_samples - samples.size(1)) % self.capacity
+        first = min(samples.size(1), self.capacity - pos)
+        self.buffer[:, pos:pos + first] = samples[:, :first]
+        self.buffer[:, :samples.size(1) - first] = samples[:, first:]
+        self.written += num_samples
+
+    def read(self, start, end):
+        assert self.written - self.capacity <= start <= end <= self.written, "range is no longer buffered"
+        idx = torch.arange(start, end) % self.capacity
+        return self.buffer[:, idx]
+
+    def latest(self, num_samples):
+        return self.read(max(self.written - num_samples, 0), self.written)
+
+# Online SepID: push() takes frames of mixture audio. Every hop_seconds of new input, SepFormer
+# separates the last block_seconds held in the input ring buffer. The new block's sources are
+# permuted to match the previous block over their overlap (BatchSeparator._align), so stream k
+# stays the same talker, and only the new hop of each source goes to that stream's ring buffer.
+# Every embed_every blocks, each stream's last embed_seconds is embedded and folded into a running
+# embedding (exponential moving average), and the streams are jointly assigned distinct speakers
+# from the GalleryIndex. If processing falls behind by more than max_latency_seconds, the backlog is
+# dropped and separation resumes at the newest block, which keeps latency bounded.
+class StreamingSepID:
+    def __init__(self, separator, embedder, gallery, block_seconds=2.0, hop_seconds=0.5,
+                 embed_seconds=3.0, embed_every=2, max_latency_seconds=1.0, momentum=0.8, sample_rate=16000):
+        self.separator = separator
+        self.embedder = embedder
+        self.gallery = gallery
+        self.block = int(block_seconds * sample_rate)
+        self.hop = int(hop_seconds * sample_rate)
+        self.embed_samples = int(embed_seconds * sample_rate)
+        self.embed_every = embed_every
+        self.max_latency = int(max_latency_seconds * sample_rate)
+        self.momentum = momentum
+        self.sample_rate = sample_rate
+        self.reset()
+
+    def reset(self):
+        self.input = RingBuffer(self.block + self.max_latency + self.hop)
+        self.streams = None
+        self.running = None
+        self.processed = 0
+        self.blocks = 0
+        self.dropped_samples = 0
+        self.previous = None  # (start, end, sources) of the last separated block
+        self.compute_seconds = 0.0
+
+    def _separate(self, start, end):
+        with torch.no_grad():
+            est = self.separator.separate_batch(self.input.read(start, end)).detach().float().cpu()[0].T
+        if est.size(1) < end - start:
+            est = F.pad(est, (0, end - start - est.size(1)))
+        est = est[:, :end - start]
+        if self.previous is not None:
+            prev_start, prev_end, prev_est = self.previous
+            overlap_start = max(start, prev_start)
+            if prev_end > overlap_start:
+                est = est[list(BatchSeparator._align(prev_est[:, overlap_start - prev_start:prev_end - prev_start],
+                                                     est[:, overlap_start - start:prev_end - start]))]
+        return est
+
+    def _decide(self, end, arrival):
+        audio = [self.streams.latest(self.embed_samples)[k] for k in range(self.streams.buffer.size(0))]
+        embeddings = F.normalize(torch.from_numpy(np.stack(list(extract_embeddings_batched(audio, self.embedder)))), dim=1)
+        if self.running is None:
+            self.running = embeddings
+        else:
+            self.running = F.normalize(self.momentum * self.running + (1 - self.momentum) * embeddings, dim=1)
+        speakers, scores = self.gallery.assign(self.running.unsqueeze(0).numpy())
+        return [{"time": end / self.sample_rate, "stream": k, "speaker": speaker,
+                 "score": float(scores[0, k]), "latency": time.perf_counter() - arrival}
+                for k, speaker in enumerate(speakers[0])]
+
+    # Feed one frame; returns the decisions emitted while processing it
+    def push(self, frame, arrival=None):
+        arrival = time.perf_counter() if arrival is None else arrival
+        self.input.write(torch.as_tensor(frame, dtype=torch.float32))
+        decisions = []
+        while self.input.written - self.processed >= self.hop:
+            compute_start = time.perf_counter()
+            if self.input.written - self.processed > self.max_latency:
+                skip = self.input.written - self.hop - self.processed
+                self.dropped_samples += skip
+                self.processed += skip
+            end = self.processed + self.hop
+            start = max(end - self.block, 0)
+            est = self._separate(start, end)
+            new_from = max(self.previous[1], start) if self.previous is not None else start
+            if self.streams is None:
+                self.streams = RingBuffer(self.embed_samples, channels=est.size(0))
+            self.streams.write(est[:, new_from - start:])
+            self.previous = (start, end, est)
+            self.processed = end
+            self.blocks += 1
+            if self.blocks % self.embed_every == 0:
+                decisions.extend(self._decide(end, arrival))
+            self.compute_seconds += time.perf_counter() - compute_start
+        return decisions
+
+# Replay mixtures through a fresh StreamingSepID at real-time speed (frames are released on the
+# wall clock, so latency includes waiting in the input buffer) and report decision latency, real-time
+# factor and the permutation-invariant accuracy of each stream's last decision
+def benchmark_streaming(stream, waveforms, true_ids, frame_seconds=0.02, realtime=True):
+    frame = int(frame_seconds * stream.sample_rate)
+    latencies, correct, audio_seconds, compute_seconds, dropped = [], 0, 0.0, 0.0, 0
+    for waveform, ids in zip(waveforms, true_ids):
+        stream.reset()
+        final = {}
+        replay_start = time.perf_counter()
+        for offset in range(0, waveform.size(0), frame):
+            arrival = replay_start + (offset + frame) / stream.sample_rate
+            if realtime and time.perf_counter() < arrival:
+                time.sleep(arrival - time.perf_counter())
+            for decision in stream.push(waveform[offset:offset + frame], arrival if realtime else None):
+                latencies.append(decision["latency"])
+                final[decision["stream"]] = decision["speaker"]
+        correct += sorted(final.values()) == sorted(ids)
+        audio_seconds += waveform.size(0) / stream.sample_rate
+        compute_seconds += stream.compute_seconds
+        dropped += stream.dropped_samples
+    latencies = np.asarray(latencies) * 1000
+    print(f"Streaming: {len(latencies)} decisions, latency mean {latencies.mean():.0f} ms, "
+          f"p95 {np.percentile(latencies, 95):.0f} ms, max {latencies.max():.0f} ms")
+    print(f"Streaming: RTF {compute_seconds / audio_seconds:.3f}, dropped {dropped / stream.sample_rate:.1f}s of input, "
+          f"rank-1 accuracy {100 * correct / len(waveforms):.2f}%")
+    return {"latency_ms": latencies, "rtf": compute_seconds / audio_seconds, "accuracy": correct / len(waveforms)}
+
+streaming = StreamingSepID(sep_model, finetuned_model, gallery_finetuned)
+streaming_mixtures = [torchaudio.load(os.path.join(test_dir, f"mix_{i}.wav"))[0].squeeze(0) for i in test_mixture_ids[:10]]
+streaming_results = benchmark_streaming(streaming, streaming_mixtures, [test_manifest[i]["speakers"] for i in test_mixture_ids[:10]])
+
 """# Q. IV A,B"""
 
 pip install pesq
@@ -662,63 +2758,185 @@ device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 voxceleb2_root = "/content/drive/MyDrive/Colab Notebooks/SEM03-Assignments/Speech Understanding/Assignment2/vox2/aac"
 train_dir = "/content/drive/MyDrive/Colab Notebooks/SEM03-Assignments/Speech Understanding/Assignment2/output/train_mixtures"
 test_dir = "/content/drive/MyDrive/Colab Notebooks/SEM03-Assignments/Speech Understanding/Assignment2/output/test_mixtures"
+embedding_store = EmbeddingStore("/content/drive/MyDrive/Colab Notebooks/SEM03-Assignments/Speech Understanding/Assignment2/embedding_store")
+separation_cache = SeparationCache("/content/drive/MyDrive/Colab Notebooks/SEM03-Assignments/Speech Understanding/Assignment2/separation_cache")
 
 
 # Load models
 model_name = "microsoft/wavlm-base-plus"
-feature_extractor = Wav2Vec2FeatureExtractor.from_pretrained(model_name)
-pretrained_wavlm = WavLMModel.from_pretrained(model_name).to(device)
-pretrained_wavlm.eval()
+wavlm_inputs = WavLMInputNormalizer.from_feature_extractor(Wav2Vec2FeatureExtractor.from_pretrained(model_name))
 
-# Fine-tuned WavLM with LoRA
+# Fine-tuned WavLM with LoRA (the pre-trained model is its base with adapters disabled)
 finetuned_wavlm = WavLMModel.from_pretrained(model_name).to(device)
 lora_config = LoraConfig(r=32, lora_alpha=32, target_modules=["attention.q_proj", "attention.k_proj", "attention.v_proj", "attention.out_proj"], lora_dropout=0.1)
 finetuned_wavlm = get_peft_model(finetuned_wavlm, lora_config)
 
-# SepFormer
-sepformer = SepformerSeparation.from_hparams(source="speechbrain/sepformer-wsj02mix", savedir="pretrained_models/sepformer-wsj02mix").to(device)
+# SepFormer (Pretrained freezes its parameters by default; this one is fine-tuned)
+sepformer = SepformerSeparation.from_hparams(source="speechbrain/sepformer-wsj02mix", savedir="pretrained_models/sepformer-wsj02mix",
+                                             run_opts={"device": str(device)}, freeze_params=False)
+sepformer.mods.requires_grad_(True)
 
 # Dataset
 class MultiSpeakerDataset(Dataset):
-    def __init__(self, data_dir, max_length=48000):
+    def __init__(self, data_dir, max_length=48000, cache=None):
         self.data_dir = data_dir
         self.max_length = max_length
+        self.cache = cache
         self.files = [f for f in os.listdir(data_dir) if f.startswith("mix_") and f.endswith(".wav")]
+        self.manifest = load_mixture_manifest(data_dir)
 
     def __len__(self):
         return len(self.files)
 
+    def paths(self, idx):
+        # Sources share the mixture's number, which is not its position in os.listdir order
+        mix_id = self.files[idx][len("mix_"):-len(".wav")]
+        return [os.path.join(self.data_dir, name) for name in (self.files[idx], f"src1_{mix_id}.wav", f"src2_{mix_id}.wav")]
+
+    # 16 kHz length of every mixture, for the bucketing sampler: from the audio cache, else from
+    # the length in the mixture manifest (mixture directories are flat, so the file index does not
+    # cover them); only mixtures without a record are probed
+    def lengths(self):
+        if self.cache is not None:
+            return [int(self.cache.length[self.cache.position[self.paths(i)[0]]]) for i in range(len(self))]
+        lengths = []
+        for i in range(len(self)):
+            record = self.manifest.get(int(self.files[i][len("mix_"):-len(".wav")]))
+            lengths.append(record["length"] if record is not None else utterance_length(self.paths(i)[0]))
+        return lengths
+
     def __getitem__(self, idx):
-        mix_path = os.path.join(self.data_dir, self.files[idx])
-        src1_path = os.path.join(self.data_dir, f"src1_{idx}.wav")
-        src2_path = os.path.join(self.data_dir, f"src2_{idx}.wav")
-
-        mix, sr = torchaudio.load(mix_path)
-        src1, _ = torchaudio.load(src1_path)
-        src2, _ = torchaudio.load(src2_path)
-
-        if sr != 16000:
-            mix = torchaudio.transforms.Resample(sr, 16000)(mix)
-            src1 = torchaudio.transforms.Resample(sr, 16000)(src1)
-            src2 = torchaudio.transforms.Resample(sr, 16000)(src2)
-
-        mix, src1, src2 = mix.squeeze(0), src1.squeeze(0), src2.squeeze(0)
-        if mix.size(0) > self.max_length:
-            mix, src1, src2 = mix[:self.max_length], src1[:self.max_length], src2[:self.max_length]
-        elif mix.size(0) < self.max_length:
-            padding = torch.zeros(self.max_length - mix.size(0))
-            mix = torch.cat([mix, padding])
-            src1 = torch.cat([src1, padding])
-            src2 = torch.cat([src2, padding])
-
-        # Extract IDs from filenames (assuming format src1_idXXXXX_idx.wav)
+        crop_length = None
+        if isinstance(idx, tuple):  # (index, crop_length, seed) from BucketBatchSampler
+            idx, crop_length, seed = idx
+        mix_path, src1_path, src2_path = self.paths(idx)
+
+        if crop_length is not None:
+            # Same random crop for the mixture and both sources, left unpadded for the collate
+            if self.cache is not None:
+                start = crop_offset(int(self.cache.length[self.cache.position[mix_path]]), crop_length, seed)
+                mix, src1, src2 = (self.cache.load_path(path, start, crop_length) for path in (mix_path, src1_path, src2_path))
+            else:
+                mix, src1, src2 = load_audio_batch([mix_path, src1_path, src2_path])
+                start = crop_offset(mix.size(0), crop_length, seed)
+                mix, src1, src2 = (w[start:start + crop_length] for w in (mix, src1, src2))
+        else:
+            if self.cache is not None:
+                mix, src1, src2 = (self.cache.load_path(path, 0, self.max_length) for path in (mix_path, src1_path, src2_path))
+            else:
+                mix, src1, src2 = load_audio_batch([mix_path, src1_path, src2_path])
+            if mix.size(0) > self.max_length:
+                mix, src1, src2 = mix[:self.max_length], src1[:self.max_length], src2[:self.max_length]
+            elif mix.size(0) < self.max_length:
+                padding = torch.zeros(self.max_length - mix.size(0))
+                mix = torch.cat([mix, padding])
+                src1 = torch.cat([src1, padding])
+                src2 = torch.cat([src2, padding])
+
+        # Speaker IDs from the mixture manifest, else from filenames (assuming format src1_idXXXXX_idx.wav)
+        record = self.manifest.get(int(self.files[idx][len("mix_"):-len(".wav")]))
+        if record is not None:
+            id1, id2 = record["speakers"]
+            return mix, src1, src2, id1, id2
         id1 = src1_path.split("src1_")[1].split("_")[0] if "src1_" in src1_path else os.path.basename(os.path.dirname(os.path.dirname(src1_path)))
         id2 = src2_path.split("src2_")[1].split("_")[0] if "src2_" in src2_path else os.path.basename(os.path.dirname(os.path.dirname(src2_path)))
         return mix, src1, src2, id1, id2
 
-# Load datasets
-train_dataset = MultiSpeakerDataset(train_dir)
-train_loader = DataLoader(train_dataset, batch_size=4, shuffle=True)
+# Pads (mix, src1, src2, id1, id2) items from the bucketing sampler to the longest crop
+class MixtureCollate:
+    def __call__(self, items):
+        lengths = torch.tensor([item[0].size(0) for item in items])
+        mix, src1, src2 = (torch.zeros(len(items), int(lengths.max())) for _ in range(3))
+        for row, (m, s1, s2, _, _) in enumerate(items):
+            mix[row, :m.size(0)], src1[row, :s1.size(0)], src2[row, :s2.size(0)] = m, s1, s2
+        id1 = [item[3] for item in items]
+        id2 = [item[4] for item in items]
+        if torch.is_tensor(id1[0]):  # speaker indices from DynamicMixingDataset
+            id1, id2 = torch.stack(id1), torch.stack(id2)
+        return mix, src1, src2, id1, id2, lengths
+
+# Source pool held in memory, with the same interface as AudioCache
+class InMemoryAudioPool:
+    def __init__(self, waveforms, speakers):
+        self.waveforms = waveforms
+        self.speakers = speakers
+        self.length = np.asarray([w.size(0) for w in waveforms], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.waveforms)
+
+    def load(self, i, start=0, num_samples=None):
+        stop = None if num_samples is None else start + num_samples
+        return self.waveforms[i][start:stop]
+
+# Dynamic mixing: every item draws two speakers, one utterance of each, random crops and
+# gains from a speaker-labelled source pool (AudioCache or InMemoryAudioPool) and mixes them
+# with mix_sources, so training mixtures are unlimited and never written to disk. Item idx is
+# seeded by (seed, idx); EpochOffsetSampler hands out fresh indices every epoch.
+class DynamicMixingDataset(Dataset):
+    def __init__(self, source_pool, speaker_ids, mixtures_per_epoch=10000, max_length=48000, gain_range=(0.5, 1.0), seed=0):
+        self.pool = source_pool
+        self.speaker_to_idx = {speaker_id: idx for idx, speaker_id in enumerate(speaker_ids)}
+        self.mixtures_per_epoch = mixtures_per_epoch
+        self.max_length = max_length
+        self.gain_range = gain_range
+        self.seed = seed
+        self.utterances = {}
+        for i, speaker_id in enumerate(source_pool.speakers):
+            if speaker_id in self.speaker_to_idx:
+                self.utterances.setdefault(self.speaker_to_idx[speaker_id], []).append(i)
+        self.speakers = sorted(self.utterances)
+
+    def __len__(self):
+        return self.mixtures_per_epoch
+
+    def _source(self, rng, speaker):
+        i = rng.choice(self.utterances[speaker])
+        start = rng.randint(0, max(int(self.pool.length[i]) - self.max_length, 0))
+        return fit_length(self.pool.load(i, start, self.max_length), self.max_length)
+
+    def __getitem__(self, idx):
+        rng = random.Random(f"{self.seed}-{idx}")
+        spk1, spk2 = rng.sample(self.speakers, 2)
+        src1, src2 = self._source(rng, spk1), self._source(rng, spk2)
+        gain1, gain2 = rng.uniform(*self.gain_range), rng.uniform(*self.gain_range)
+        mix = mix_sources(src1, src2, gain1, gain2)
+        return mix, src1, src2, torch.tensor(spk1), torch.tensor(spk2)
+
+# Yields a new block of dataset indices each epoch (epoch * n ... epoch * n + n - 1, shuffled)
+class EpochOffsetSampler:
+    def __init__(self, num_items, seed=0):
+        self.num_items = num_items
+        self.seed = seed
+        self.epoch = 0
+
+    def __len__(self):
+        return self.num_items
+
+    def __iter__(self):
+        indices = list(range(self.epoch * self.num_items, (self.epoch + 1) * self.num_items))
+        random.Random(self.seed + self.epoch).shuffle(indices)
+        self.epoch += 1
+        return iter(indices)
+
+all_ids = open_file_index(voxceleb2_root).speakers()
+train_ids = all_ids[:50]
+test_ids = all_ids[50:100]
+
+# Load datasets: dynamic mixing from a cached pool of training-speaker utterances, or the
+# pre-rendered mixtures (decoded once into a local audio cache)
+dynamic_mixing = True
+if dynamic_mixing:
+    source_files = open_file_index(voxceleb2_root).labelled_files(train_ids, extensions=(".m4a",))
+    source_pool = build_audio_cache(source_files, "/content/audio_cache/vox2_mixing_pool")
+    train_dataset = DynamicMixingDataset(source_pool, train_ids, mixtures_per_epoch=2000)
+    train_loader = make_loader(train_dataset, batch_size=4, sampler=EpochOffsetSampler(len(train_dataset)), collate_fn=MixtureCollate())
+else:
+    mixture_cache = build_audio_cache([(os.path.join(train_dir, f), None) for f in sorted(os.listdir(train_dir)) if f.endswith(".wav")],
+                                      "/content/audio_cache/train_mixtures")
+    train_dataset = MultiSpeakerDataset(train_dir, cache=mixture_cache)
+    train_sampler = BucketBatchSampler(train_dataset.lengths(), max_samples_per_batch=4 * 48000)
+    train_loader = make_loader(train_dataset, batch_sampler=train_sampler, collate_fn=MixtureCollate())
 test_dataset = MultiSpeakerDataset(test_dir)
 
 # Identification loss
@@ -740,125 +2958,92 @@ class ArcFaceLoss(nn.Module):
         return F.cross_entropy(output, labels)
 
 # Training setup
-train_ids = sorted([d for d in os.listdir(voxceleb2_root) if os.path.isdir(os.path.join(voxceleb2_root, d))])[:50]
-test_ids = sorted([d for d in os.listdir(voxceleb2_root) if os.path.isdir(os.path.join(voxceleb2_root, d))])[50:100]
 id_to_idx = {id: idx for idx, id in enumerate(train_ids)}
-optimizer = torch.optim.Adam(list(sepformer.parameters()) + list(finetuned_wavlm.parameters()), lr=1e-4)
+optimizer = torch.optim.Adam([p for p in list(sepformer.mods.parameters()) + list(finetuned_wavlm.parameters()) if p.requires_grad], lr=1e-4)
 arcface_loss = ArcFaceLoss(in_features=768, out_features=len(train_ids)).to(device)
-cosine_similarity = nn.CosineSimilarity(dim=0, eps=1e-6)
 
 # Fine-tuning loop
 def train_pipeline():
     sepformer.train()
     finetuned_wavlm.train()
+    gradient_checked = False
     for epoch in range(5):
         total_loss = 0
-        for mix, src1, src2, id1, id2 in tqdm(train_loader, desc=f"Epoch {epoch+1}"):
+        padding_fractions = []
+        timer = StepTimer()
+        for mix, src1, src2, id1, id2, lengths in tqdm(timer.iterate(train_loader), total=len(train_loader), desc=f"Epoch {epoch+1}"):
+            padding_fractions.append(1.0 - float(lengths.sum()) / mix.numel())
             mix, src1, src2 = mix.to(device), src1.to(device), src2.to(device)
-            print(f"ID1: {id1}, ID2: {id2}")  # Debug
-            labels = torch.tensor([id_to_idx[i] for i in id1] + [id_to_idx[i] for i in id2], dtype=torch.long).to(device)
+            if torch.is_tensor(id1):
+                labels = torch.cat([id1, id2]).to(device)
+            else:
+                labels = torch.tensor([id_to_idx[i] for i in id1] + [id_to_idx[i] for i in id2], dtype=torch.long).to(device)
 
             optimizer.zero_grad()
-            est_sources = sepformer(mix.unsqueeze(1))  # [batch, samples, 2]
-            print(f"SepFormer output shape: {est_sources.shape}")
-            est1, est2 = est_sources[..., 0], est_sources[..., 1]
-
-            inputs1 = feature_extractor(est1.tolist(), sampling_rate=16000, return_tensors="pt", padding=True)
-            inputs2 = feature_extractor(est2.tolist(), sampling_rate=16000, return_tensors="pt", padding=True)
-            emb1 = finetuned_wavlm(inputs1["input_values"].to(device)).last_hidden_state.mean(dim=1)
-            emb2 = finetuned_wavlm(inputs2["input_values"].to(device)).last_hidden_state.mean(dim=1)
-            embeddings = torch.cat([emb1, emb2], dim=0)
-
-            sep_loss = -torch.mean(torch.tensor([compute_sdr(src1[i].cpu().numpy(), est1[i].cpu().numpy()) +
-                                                compute_sdr(src2[i].cpu().numpy(), est2[i].cpu().numpy())
-                                                for i in range(mix.size(0))], requires_grad=True).to(device))
+            est_sources = sepformer.separate_batch(mix)  # [batch, samples, 2]
+            # PIT SI-SDR on the padded batch; estimates come back in reference (label) order
+            sep_metrics = separation_metrics(est_sources.transpose(1, 2), torch.stack([src1, src2], dim=1), lengths)
+            est1, est2 = sep_metrics["estimates"].unbind(dim=1)
+
+            # Normalised on the device without leaving the graph, so the ID loss also reaches SepFormer
+            input_values, attention_mask, est_lengths = wavlm_inputs(torch.cat([est1, est2]), torch.cat([lengths, lengths]))
+            embeddings = pooled_embeddings(finetuned_wavlm, input_values, attention_mask, est_lengths)
+
+            sep_loss = -sep_metrics["si_sdr"].mean()
             id_loss = arcface_loss(embeddings, labels)
             loss = sep_loss + 0.1 * id_loss
+            if not gradient_checked:
+                # Once: the ID loss alone must reach SepFormer through the normaliser and WavLM
+                id_grads = torch.autograd.grad(id_loss, list(sepformer.mods.parameters()), retain_graph=True, allow_unused=True)
+                assert any(g is not None for g in id_grads), "ID loss does not reach SepFormer"
             loss.backward()
+            if not gradient_checked:
+                # Once: the separation loss must actually reach SepFormer's weights
+                assert any(p.grad is not None for p in sepformer.mods.parameters()), "SepFormer received no gradient"
+                gradient_checked = True
             optimizer.step()
             total_loss += loss.item()
-        print(f"Epoch {epoch+1}, Average Loss: {total_loss / len(train_loader):.4f}")
-
-# Metric functions
-def compute_sdr(ref, est):
-    s_target = ref
-    e_noise = est - ref
-    return 10 * np.log10(np.mean(s_target**2) / (np.mean(e_noise**2) + 1e-8))
-
-def compute_sir(ref, est, interferer):
-    s_target = ref
-    e_interf = interferer
-    return 10 * np.log10(np.mean(s_target**2) / (np.mean(e_interf**2) + 1e-8))
-
-def compute_sar(ref, est):
-    s_target = ref
-    e_artifacts = est - ref
-    return 10 * np.log10(np.mean(s_target**2) / (np.mean(e_artifacts**2) + 1e-8))
+        print(f"Epoch {epoch+1}, Average Loss: {total_loss / len(train_loader):.4f}, Padding fraction: {np.mean(padding_fractions):.3f}")
+        timer.report(f"Epoch {epoch+1}: ")
 
 # Evaluation
 def evaluate_pipeline():
     sepformer.eval()
-    pretrained_wavlm.eval()
     finetuned_wavlm.eval()
-    results = {"SIR": [], "SAR": [], "SDR": [], "PESQ": []}
+    dual_wavlm = DualWavLMEmbedder(finetuned_wavlm).eval()
+    separator = BatchSeparator(sepformer, cache=separation_cache)
     correct_pre, correct_fin, total = 0, 0, 0
 
-    ref_emb_pre, ref_emb_fin = {}, {}
-    for speaker_id in test_ids:
-        speaker_path = os.path.join(voxceleb2_root, speaker_id, os.listdir(os.path.join(voxceleb2_root, speaker_id))[0])
-        file = os.path.join(speaker_path, os.listdir(speaker_path)[0])
-        waveform, sr = torchaudio.load(file)
-        if sr != 16000:
-            waveform = torchaudio.transforms.Resample(sr, 16000)(waveform)
-        waveform = waveform.squeeze(0).numpy()
-        ref_emb_pre[speaker_id] = extract_embedding(waveform, pretrained_wavlm)
-        ref_emb_fin[speaker_id] = extract_embedding(waveform, finetuned_wavlm)
-
-    with torch.no_grad():
-        for i in tqdm(range(len(test_dataset)), desc="Evaluating"):
-            mix, src1, src2, id1, id2 = test_dataset[i]
-            mix = mix.unsqueeze(0).to(device)
-            src1, src2 = src1.numpy(), src2.numpy()
-
-            est_sources = sepformer(mix.unsqueeze(1)).squeeze(0).cpu().numpy()
-            est1, est2 = est_sources[:, 0], est_sources[:, 1]
-
-            min_len = min(est1.shape[0], src1.shape[0])
-            est1, est2 = est1[:min_len], est2[:min_len]
-            src1, src2 = src1[:min_len], src2[:min_len]
-
-            results["SIR"].extend([compute_sir(src1, est1, src2), compute_sir(src2, est2, src1)])
-            results["SAR"].extend([compute_sar(src1, est1), compute_sar(src2, est2)])
-            results["SDR"].extend([compute_sdr(src1, est1), compute_sdr(src2, est2)])
-            results["PESQ"].extend([pesq(16000, src1, est1, "wb"), pesq(16000, src2, est2, "wb")])
-
-            emb1_pre = extract_embedding(est1, pretrained_wavlm)
-            emb2_pre = extract_embedding(est2, pretrained_wavlm)
-            emb1_fin = extract_embedding(est1, finetuned_wavlm)
-            emb2_fin = extract_embedding(est2, finetuned_wavlm)
-
-            pre_scores, fin_scores = {}, {}
-            for sid in test_ids:
-                ref_pre = torch.from_numpy(ref_emb_pre[sid]).to(device)
-                ref_fin = torch.from_numpy(ref_emb_fin[sid]).to(device)
-                pre_scores[sid] = [cosine_similarity(torch.from_numpy(emb1_pre).to(device), ref_pre).item(),
-                                   cosine_similarity(torch.from_numpy(emb2_pre).to(device), ref_pre).item()]
-                fin_scores[sid] = [cosine_similarity(torch.from_numpy(emb1_fin).to(device), ref_fin).item(),
-                                   cosine_similarity(torch.from_numpy(emb2_fin).to(device), ref_fin).item()]
-
-            pred_id1_pre = max(pre_scores, key=lambda k: pre_scores[k][0])
-            pred_id2_pre = max(pre_scores, key=lambda k: pre_scores[k][1])
-            pred_id1_fin = max(fin_scores, key=lambda k: fin_scores[k][0])
-            pred_id2_fin = max(fin_scores, key=lambda k: fin_scores[k][1])
-
-            pre_correct = (pred_id1_pre == id1 and pred_id2_pre == id2) or (pred_id1_pre == id2 and pred_id2_pre == id1)
-            fin_correct = (pred_id1_fin == id1 and pred_id2_fin == id2) or (pred_id1_fin == id2 and pred_id2_fin == id1)
-            correct_pre += pre_correct
-            correct_fin += fin_correct
-            total += 1
-
+    ref_files = [open_file_index(voxceleb2_root).first_file(speaker_id) for speaker_id in test_ids]
+    ref_pre, ref_fin = embedding_store.embed_files(ref_files, dual_wavlm)
+    gallery_pre, gallery_fin = GalleryIndex(test_ids, ref_pre), GalleryIndex(test_ids, ref_fin)
+
+    with torch.no_grad(), ScoringPool() as scorer:
+        for group_start in tqdm(range(0, len(test_dataset), 8), desc="Evaluating"):
+            items = [test_dataset[i] for i in range(group_start, min(group_start + 8, len(test_dataset)))]
+            separated = separator([item[0] for item in items])
+            for i, (mix, src1, src2, id1, id2), est in zip(itertools.count(group_start), items, separated):
+                refs = torch.stack([src1, src2]).unsqueeze(0)
+                metrics = separation_metrics(est.unsqueeze(0), refs)
+                est1, est2 = metrics["estimates"][0].numpy()
+
+                scorer.record(i, SIR=metrics["sir"][0].tolist(), SAR=metrics["sar"][0].tolist(),
+                              SDR=metrics["sdr"][0].tolist(), **{"SI-SDR": metrics["si_sdr"][0].tolist()})
+                scorer.submit(i, refs[0, :, :est1.shape[0]].numpy(), np.stack([est1, est2]))
+
+                # Joint assignment of distinct speakers to the two streams
+                stream_embeddings = np.stack(list(extract_embeddings_batched([est1, est2], dual_wavlm)))  # [stream, model, dim]
+                pred_pre = gallery_pre.assign(stream_embeddings[None, :, 0])[0][0]
+                pred_fin = gallery_fin.assign(stream_embeddings[None, :, 1])[0][0]
+
+                correct_pre += sorted(pred_pre) == sorted([id1, id2])
+                correct_fin += sorted(pred_fin) == sorted([id1, id2])
+                total += 1
+
+        results = scorer.close()
+    separator.report("SepFormer: ")
     for metric in results:
-        avg = np.mean(results[metric])
+        avg = np.nanmean(results[metric])
         print(f"Average {metric}: {avg:.2f}")
     rank1_pre = correct_pre / total * 100
     rank1_fin = correct_fin / total * 100
@@ -867,12 +3052,7 @@ def evaluate_pipeline():
 
 # Extract embedding
 def extract_embedding(waveform, model):
-    inputs = feature_extractor(waveform.tolist(), sampling_rate=16000, return_tensors="pt", padding=True)
-    input_values = inputs["input_values"].to(device)
-    with torch.no_grad():
-        outputs = model(input_values)
-        embedding = outputs.last_hidden_state.mean(dim=1).squeeze().cpu().numpy()
-    return embedding
+    return next(extract_embeddings_batched([waveform], model))
 
 # Run pipeline
 print("Training SepID-Enhance Pipeline...")